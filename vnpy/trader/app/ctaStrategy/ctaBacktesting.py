@@ -6,23 +6,16 @@
 '''
 from __future__ import division
 
+import sys
 from datetime import datetime, timedelta
 from collections import OrderedDict
 from itertools import product
 import multiprocessing
-import copy
+import heapq
 
 import pymongo
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-
-# 如果安装了seaborn则设置为白色风格
-try:
-    import seaborn as sns       
-    sns.set_style('whitegrid')  
-except ImportError:
-    pass
 
 from vnpy.trader.vtGlobal import globalSetting
 from vnpy.trader.vtObject import VtTickData, VtBarData
@@ -32,6 +25,21 @@ from vnpy.trader.vtGateway import VtOrderData, VtTradeData
 from .ctaBase import *
 
 
+# Python 3.7起内置dict已保持插入顺序，且比OrderedDict更快
+if sys.version_info >= (3, 7):
+    OrderedDictType = dict
+else:
+    OrderedDictType = OrderedDict
+
+# 成交方向对应的持仓变化符号，查表代替逐笔的条件判断
+DIRECTION_SIGN = {DIRECTION_LONG: 1, DIRECTION_SHORT: -1}
+
+# 并行回测打包历史数据时，每条记录中字段的状态
+FIELD_VALUE = 0         # 有值
+FIELD_NONE = 1          # 值为None
+FIELD_MISSING = 2       # 记录中没有该字段
+
+
 ########################################################################
 class BacktestingEngine(object):
     """
@@ -53,6 +61,11 @@ class BacktestingEngine(object):
         self.stopOrderDict = {}             # 停止单撤销后不会从本字典中删除
         self.workingStopOrderDict = {}      # 停止单撤销后会从本字典中删除
         
+        # 活动停止单的价格堆，用于快速找出会触发的停止单
+        # 堆中元素为(价格, 编号, 停止单)，撤销或触发后不立即从堆中删除
+        self.buyStopOrderHeap = []          # 买入停止单，价格从低到高
+        self.sellStopOrderHeap = []         # 卖出停止单，价格从高到低（价格取负）
+        
         self.engineType = ENGINETYPE_BACKTESTING    # 引擎类型为回测
         
         self.strategy = None        # 回测策略
@@ -70,6 +83,8 @@ class BacktestingEngine(object):
         
         self.dbClient = None        # 数据库客户端
         self.dbCursor = None        # 数据库指针
+        self.backtestData = None    # 直接设置的回测数据对象列表，为None时从数据库指针逐条读取，修改数据相关设置后清空
+        self.historyData = None     # 打包的历史数据和初始化数据数量，并行回测时子进程从共享内存中设置
         
         self.initData = []          # 初始化用的数据
         self.dbName = ''            # 回测数据库名
@@ -80,11 +95,17 @@ class BacktestingEngine(object):
         self.strategyStartDate = None   # 策略启动日期（即前面的数据用于初始化），datetime对象
         
         self.limitOrderCount = 0                    # 限价单编号
-        self.limitOrderDict = OrderedDict()         # 限价单字典
-        self.workingLimitOrderDict = OrderedDict()  # 活动限价单字典，用于进行撮合用
+        self.limitOrderDict = OrderedDictType()         # 限价单字典
+        self.workingLimitOrderDict = OrderedDictType()  # 活动限价单字典，用于进行撮合用
+        
+        # 活动限价单的价格堆，用于快速找出会成交的限价单
+        # 堆中元素为(价格, 编号, 委托)，撤销或成交后不立即从堆中删除
+        self.buyOrderHeap = []                      # 买入限价单，价格从高到低（价格取负）
+        self.sellOrderHeap = []                     # 卖出限价单，价格从低到高
+        self.newOrderList = []                      # 尚未推送未成交状态的新限价单
         
         self.tradeCount = 0             # 成交编号
-        self.tradeDict = OrderedDict()  # 成交字典
+        self.tradeDict = OrderedDictType()  # 成交字典
         
         self.logList = []               # 日志记录
         
@@ -92,9 +113,11 @@ class BacktestingEngine(object):
         self.tick = None
         self.bar = None
         self.dt = None      # 最新的时间
+        self.dtTime = ''    # 最新时间的字符串（时:分:秒），随最新时间一起更新
         
         # 日线回测结果计算用
         self.dailyResultDict = OrderedDict()
+        self.dailyResult = None         # 当日的结果对象，同一日内直接更新收盘价
     
     #------------------------------------------------
     # 通用功能
@@ -103,10 +126,12 @@ class BacktestingEngine(object):
     #----------------------------------------------------------------------
     def roundToPriceTick(self, price):
         """取整价格到合约最小价格变动"""
-        if not self.priceTick:
+        priceTick = self.priceTick
+        if not priceTick:
             return price
         
-        newPrice = round(price/self.priceTick, 0) * self.priceTick
+        # 必须用除法，乘以最小变动的倒数在浮点下可能使半个最小变动的价格取整方向不同
+        newPrice = round(price/priceTick, 0) * priceTick
         return newPrice
 
     #----------------------------------------------------------------------
@@ -123,6 +148,8 @@ class BacktestingEngine(object):
         """设置回测的启动日期"""
         self.startDate = startDate
         self.initDays = initDays
+        self.backtestData = None
+        self.historyData = None
         
         self.dataStartDate = datetime.strptime(startDate, '%Y%m%d')
         
@@ -133,6 +160,8 @@ class BacktestingEngine(object):
     def setEndDate(self, endDate=''):
         """设置回测的结束日期"""
         self.endDate = endDate
+        self.backtestData = None
+        self.historyData = None
         
         if endDate:
             self.dataEndDate = datetime.strptime(endDate, '%Y%m%d')
@@ -144,12 +173,37 @@ class BacktestingEngine(object):
     def setBacktestingMode(self, mode):
         """设置回测模式"""
         self.mode = mode
+        self.backtestData = None
+        self.historyData = None
     
     #----------------------------------------------------------------------
     def setDatabase(self, dbName, symbol):
         """设置历史数据所用的数据库"""
         self.dbName = dbName
         self.symbol = symbol
+        self.backtestData = None
+        self.historyData = None
+        
+    #----------------------------------------------------------------------
+    def setHistoryData(self, initData, backtestData):
+        """
+        直接设置历史数据，回测时不再从数据库载入
+        initData：初始化用的数据对象（K线或Tick）列表
+        backtestData：回测用的数据对象（K线或Tick）列表
+        """
+        self.initData = initData
+        self.backtestData = backtestData
+        self.historyData = None
+        
+    #----------------------------------------------------------------------
+    def setHistoryArray(self, history, initCount):
+        """
+        设置打包的历史数据，回测时不再从数据库载入，
+        每次回测时才逐条生成数据对象，各次回测之间不共享数据对象
+        history：packHistoryData打包的数据
+        initCount：前面用于初始化的数据数量
+        """
+        self.historyData = (history, initCount)
     
     #----------------------------------------------------------------------
     def setCapital(self, capital):
@@ -187,6 +241,12 @@ class BacktestingEngine(object):
         collection = self.dbClient[self.dbName][self.symbol]          
 
         self.output(u'开始载入数据')
+        
+        # datetime字段上已有索引时（导入历史数据时创建），指定查询和排序直接走该索引，
+        # 回测只读取数据，不在这里创建索引
+        indexKey = [('datetime', pymongo.ASCENDING)]
+        indexList = [index['key'] for index in collection.index_information().values()]
+        hasIndex = indexKey in indexList
       
         # 首先根据回测模式，确认要使用的数据类
         if self.mode == self.BAR_MODE:
@@ -195,18 +255,20 @@ class BacktestingEngine(object):
         else:
             dataClass = VtTickData
             func = self.newTick
+            
+        # 只读取数据类中定义的字段，避免传输和解码_id等多余内容
+        projection = dict.fromkeys(dataClass().__dict__.keys(), True)
+        projection['_id'] = False
 
         # 载入初始化需要用的数据
         flt = {'datetime':{'$gte':self.dataStartDate,
                            '$lt':self.strategyStartDate}}        
-        initCursor = collection.find(flt).sort('datetime')
+        initCursor = collection.find(flt, projection).sort('datetime').batch_size(10000)
+        if hasIndex:
+            initCursor.hint(indexKey)     # 索引不存在时指定hint会导致查询失败
         
         # 将数据从查询指针中读取出，并生成列表
-        self.initData = []              # 清空initData列表
-        for d in initCursor:
-            data = dataClass()
-            data.__dict__ = d
-            self.initData.append(data)      
+        self.initData = list(iterData(initCursor, dataClass))
         
         # 载入回测数据
         if not self.dataEndDate:
@@ -214,16 +276,15 @@ class BacktestingEngine(object):
         else:
             flt = {'datetime':{'$gte':self.strategyStartDate,
                                '$lte':self.dataEndDate}}  
-        self.dbCursor = collection.find(flt).sort('datetime')
+        self.dbCursor = collection.find(flt, projection).sort('datetime').batch_size(10000)
+        if hasIndex:
+            self.dbCursor.hint(indexKey)
         
         self.output(u'载入完成，数据量：%s' %(initCursor.count() + self.dbCursor.count()))
         
     #----------------------------------------------------------------------
     def runBacktesting(self):
         """运行回测"""
-        # 载入历史数据
-        self.loadHistoryData()
-        
         # 首先根据回测模式，确认要使用的数据类
         if self.mode == self.BAR_MODE:
             dataClass = VtBarData
@@ -231,6 +292,18 @@ class BacktestingEngine(object):
         else:
             dataClass = VtTickData
             func = self.newTick
+        
+        # 载入历史数据，直接设置了历史数据时不再访问数据库
+        if self.historyData is not None:
+            # 打包的历史数据在回放时才逐条生成数据对象
+            history, initCount = self.historyData
+            self.initData = list(iterHistoryData(history, 0, initCount, dataClass))
+            dataList = iterHistoryData(history, initCount, len(history[0]), dataClass)
+        elif self.backtestData is not None:
+            dataList = self.backtestData
+        else:
+            self.loadHistoryData()
+            dataList = iterData(self.dbCursor, dataClass)     # 从数据库指针中逐条读取
 
         self.output(u'开始回测')
         
@@ -243,11 +316,9 @@ class BacktestingEngine(object):
         self.output(u'策略启动完成')
         
         self.output(u'开始回放数据')
-
-        for d in self.dbCursor:
-            data = dataClass()
-            data.__dict__ = d
-            func(data)     
+        
+        for data in dataList:
+            func(data)
             
         self.output(u'数据回放结束')
         
@@ -255,25 +326,48 @@ class BacktestingEngine(object):
     def newBar(self, bar):
         """新的K线"""
         self.bar = bar
-        self.dt = bar.datetime
+        self.dt = dt = bar.datetime
+        self.dtTime = '%02d:%02d:%02d' %(dt.hour, dt.minute, dt.second)
+        
+        # 先撮合限价单，买入委托价格高于最低价、卖出委托价格低于最高价则成交，
+        # 当前时间点前发出的委托可能的最优成交价为开盘价
+        if self.workingLimitOrderDict or self.newOrderList:
+            self.crossLimitOrder(bar.low, bar.high, bar.open, bar.open)
+        
+        # 再撮合停止单，规则和限价单相反
+        if self.workingStopOrderDict:
+            self.crossStopOrder(bar.high, bar.low, bar.open)
         
-        self.crossLimitOrder()      # 先撮合限价单
-        self.crossStopOrder()       # 再撮合停止单
         self.strategy.onBar(bar)    # 推送K线到策略中
         
-        self.updateDailyClose(bar.datetime, bar.close)
+        # 同一交易日内只需更新收盘价，日期变化时才创建新的日线结果
+        dailyResult = self.dailyResult
+        if dailyResult is not None and dailyResult.date == dt.date():
+            dailyResult.closePrice = bar.close
+        else:
+            self.updateDailyClose(dt, bar.close)
     
     #----------------------------------------------------------------------
     def newTick(self, tick):
         """新的Tick"""
         self.tick = tick
-        self.dt = tick.datetime
+        self.dt = dt = tick.datetime
+        self.dtTime = '%02d:%02d:%02d' %(dt.hour, dt.minute, dt.second)
+        
+        if self.workingLimitOrderDict or self.newOrderList:
+            self.crossLimitOrder(tick.askPrice1, tick.bidPrice1, tick.askPrice1, tick.bidPrice1)
+        
+        if self.workingStopOrderDict:
+            self.crossStopOrder(tick.lastPrice, tick.lastPrice, tick.lastPrice)
         
-        self.crossLimitOrder()
-        self.crossStopOrder()
         self.strategy.onTick(tick)
         
-        self.updateDailyClose(tick.datetime, tick.lastPrice)
+        # 同一交易日内只需更新收盘价，日期变化时才创建新的日线结果
+        dailyResult = self.dailyResult
+        if dailyResult is not None and dailyResult.date == dt.date():
+            dailyResult.closePrice = tick.lastPrice
+        else:
+            self.updateDailyClose(dt, tick.lastPrice)
         
     #----------------------------------------------------------------------
     def initStrategy(self, strategyClass, setting=None):
@@ -285,150 +379,194 @@ class BacktestingEngine(object):
         self.strategy.name = self.strategy.className
     
     #----------------------------------------------------------------------
-    def crossLimitOrder(self):
-        """基于最新数据撮合限价单"""
-        # 先确定会撮合成交的价格
-        if self.mode == self.BAR_MODE:
-            buyCrossPrice = self.bar.low        # 若买入方向限价单价格高于该价格，则会成交
-            sellCrossPrice = self.bar.high      # 若卖出方向限价单价格低于该价格，则会成交
-            buyBestCrossPrice = self.bar.open   # 在当前时间点前发出的买入委托可能的最优成交价
-            sellBestCrossPrice = self.bar.open  # 在当前时间点前发出的卖出委托可能的最优成交价
-        else:
-            buyCrossPrice = self.tick.askPrice1
-            sellCrossPrice = self.tick.bidPrice1
-            buyBestCrossPrice = self.tick.askPrice1
-            sellBestCrossPrice = self.tick.bidPrice1
-        
-        # 遍历限价单字典中的所有限价单
-        for orderID, order in self.workingLimitOrderDict.items():
-            # 推送委托进入队列（未成交）的状态更新
-            if not order.status:
-                order.status = STATUS_NOTTRADED
-                self.strategy.onOrder(order)
-
-            # 判断是否会成交
-            buyCross = (order.direction==DIRECTION_LONG and 
-                        order.price>=buyCrossPrice and
-                        buyCrossPrice > 0)      # 国内的tick行情在涨停时askPrice1为0，此时买无法成交
-            
-            sellCross = (order.direction==DIRECTION_SHORT and 
-                         order.price<=sellCrossPrice and
-                         sellCrossPrice > 0)    # 国内的tick行情在跌停时bidPrice1为0，此时卖无法成交
-            
-            # 如果发生了成交
-            if buyCross or sellCross:
-                # 推送成交数据
-                self.tradeCount += 1            # 成交编号自增1
-                tradeID = str(self.tradeCount)
-                trade = VtTradeData()
-                trade.vtSymbol = order.vtSymbol
-                trade.tradeID = tradeID
-                trade.vtTradeID = tradeID
-                trade.orderID = order.orderID
-                trade.vtOrderID = order.orderID
-                trade.direction = order.direction
-                trade.offset = order.offset
-                
-                # 以买入为例：
-                # 1. 假设当根K线的OHLC分别为：100, 125, 90, 110
-                # 2. 假设在上一根K线结束(也是当前K线开始)的时刻，策略发出的委托为限价105
-                # 3. 则在实际中的成交价会是100而不是105，因为委托发出时市场的最优价格是100
-                if buyCross:
-                    trade.price = min(order.price, buyBestCrossPrice)
-                    self.strategy.pos += order.totalVolume
-                else:
-                    trade.price = max(order.price, sellBestCrossPrice)
-                    self.strategy.pos -= order.totalVolume
-                
-                trade.volume = order.totalVolume
-                trade.tradeTime = self.dt.strftime('%H:%M:%S')
-                trade.dt = self.dt
-                self.strategy.onTrade(trade)
-                
-                self.tradeDict[tradeID] = trade
-                
-                # 推送委托数据
-                order.tradedVolume = order.totalVolume
-                order.status = STATUS_ALLTRADED
-                self.strategy.onOrder(order)
-                
-                # 从字典中删除该限价单
-                if orderID in self.workingLimitOrderDict:
-                    del self.workingLimitOrderDict[orderID]
+    def crossLimitOrder(self, buyCrossPrice, sellCrossPrice, buyBestCrossPrice, sellBestCrossPrice):
+        """
+        基于最新数据撮合限价单
+        buyCrossPrice：若买入方向限价单价格高于该价格，则会成交
+        sellCrossPrice：若卖出方向限价单价格低于该价格，则会成交
+        buyBestCrossPrice：在当前时间点前发出的买入委托可能的最优成交价
+        sellBestCrossPrice：在当前时间点前发出的卖出委托可能的最优成交价
+        成交价格由newBar/newTick根据回测模式确定，这里不再判断模式
+        """
+        # 从价格堆中取出所有会成交的限价单
+        working = self.workingLimitOrderDict
+        heappop = heapq.heappop
+        crossList = []
+        
+        if buyCrossPrice > 0:       # 国内的tick行情在涨停时askPrice1为0，此时买无法成交
+            heap = self.buyOrderHeap
+            while heap and -heap[0][0] >= buyCrossPrice:
+                price, seq, order = heappop(heap)
+                if order.orderID in working:
+                    crossList.append((seq, True, order))
+        
+        if sellCrossPrice > 0:      # 国内的tick行情在跌停时bidPrice1为0，此时卖无法成交
+            heap = self.sellOrderHeap
+            while heap and heap[0][0] <= sellCrossPrice:
+                price, seq, order = heappop(heap)
+                if order.orderID in working:
+                    crossList.append((seq, False, order))
+        
+        # 没有新委托也没有成交时直接返回
+        if not crossList and not self.newOrderList:
+            return
+        
+        # 新委托需要先推送进入队列（未成交）的状态更新
+        newList = [(seq, None, order) for seq, order in self.newOrderList]
+        self.newOrderList = []
+        
+        # 按照委托顺序处理，同一委托先推送状态再成交
+        onOrder = self.strategy.onOrder
+        for seq, buyCross, order in sorted(newList + crossList, key=lambda x: x[0]):
+            if buyCross is None:
+                if not order.status:
+                    order.status = STATUS_NOTTRADED
+                    onOrder(order)
+            else:
+                self.fillLimitOrder(order, buyCross, buyBestCrossPrice, sellBestCrossPrice)
+        
+        # 清理堆中已经失效的委托
+        if len(self.buyOrderHeap) + len(self.sellOrderHeap) > 2 * len(working) + 100:
+            self.buyOrderHeap = compactHeap(self.buyOrderHeap, working, 'orderID')
+            self.sellOrderHeap = compactHeap(self.sellOrderHeap, working, 'orderID')
                 
     #----------------------------------------------------------------------
-    def crossStopOrder(self):
-        """基于最新数据撮合停止单"""
-        # 先确定会撮合成交的价格，这里和限价单规则相反
-        if self.mode == self.BAR_MODE:
-            buyCrossPrice = self.bar.high    # 若买入方向停止单价格低于该价格，则会成交
-            sellCrossPrice = self.bar.low    # 若卖出方向限价单价格高于该价格，则会成交
-            bestCrossPrice = self.bar.open   # 最优成交价，买入停止单不能低于，卖出停止单不能高于
+    def fillLimitOrder(self, order, buyCross, buyBestCrossPrice, sellBestCrossPrice):
+        """限价单成交"""
+        # 推送成交数据
+        self.tradeCount += 1            # 成交编号自增1
+        tradeID = str(self.tradeCount)
+        trade = VtTradeData()
+        trade.vtSymbol = order.vtSymbol
+        trade.tradeID = tradeID
+        trade.vtTradeID = tradeID
+        trade.orderID = order.orderID
+        trade.vtOrderID = order.orderID
+        trade.direction = order.direction
+        trade.offset = order.offset
+        
+        # 以买入为例：
+        # 1. 假设当根K线的OHLC分别为：100, 125, 90, 110
+        # 2. 假设在上一根K线结束(也是当前K线开始)的时刻，策略发出的委托为限价105
+        # 3. 则在实际中的成交价会是100而不是105，因为委托发出时市场的最优价格是100
+        if buyCross:
+            trade.price = min(order.price, buyBestCrossPrice)
+            self.strategy.pos += order.totalVolume
         else:
-            buyCrossPrice = self.tick.lastPrice
-            sellCrossPrice = self.tick.lastPrice
-            bestCrossPrice = self.tick.lastPrice
-        
-        # 遍历停止单字典中的所有停止单
-        for stopOrderID, so in self.workingStopOrderDict.items():
-            # 判断是否会成交
-            buyCross = so.direction==DIRECTION_LONG and so.price<=buyCrossPrice
-            sellCross = so.direction==DIRECTION_SHORT and so.price>=sellCrossPrice
+            trade.price = max(order.price, sellBestCrossPrice)
+            self.strategy.pos -= order.totalVolume
+        
+        trade.volume = order.totalVolume
+        trade.tradeTime = self.dtTime
+        trade.dt = self.dt
+        self.strategy.onTrade(trade)
+        
+        self.tradeDict[tradeID] = trade
+        
+        # 推送委托数据
+        order.tradedVolume = order.totalVolume
+        order.status = STATUS_ALLTRADED
+        self.strategy.onOrder(order)
+        
+        # 从字典中删除该限价单
+        if order.orderID in self.workingLimitOrderDict:
+            del self.workingLimitOrderDict[order.orderID]
+    
+    #----------------------------------------------------------------------
+    def crossStopOrder(self, buyCrossPrice, sellCrossPrice, bestCrossPrice):
+        """
+        基于最新数据撮合停止单
+        buyCrossPrice：若买入方向停止单价格低于该价格，则会成交
+        sellCrossPrice：若卖出方向停止单价格高于该价格，则会成交
+        bestCrossPrice：最优成交价，买入停止单不能低于，卖出停止单不能高于
+        """
+        # 从价格堆中取出所有会触发的停止单
+        working = self.workingStopOrderDict
+        heappop = heapq.heappop
+        crossList = []
+        
+        heap = self.buyStopOrderHeap
+        while heap and heap[0][0] <= buyCrossPrice:
+            price, seq, so = heappop(heap)
+            if so.stopOrderID in working:
+                crossList.append((seq, True, so))
+                
+        heap = self.sellStopOrderHeap
+        while heap and -heap[0][0] >= sellCrossPrice:
+            price, seq, so = heappop(heap)
+            if so.stopOrderID in working:
+                crossList.append((seq, False, so))
+        
+        if not crossList:
+            return
+        
+        # 按照停止单的发出顺序处理
+        crossList.sort(key=lambda x: x[0])
+        
+        strategy = self.strategy
+        dt = self.dt
+        tradeTime = self.dtTime
+        
+        for seq, buyCross, so in crossList:
+            stopOrderID = so.stopOrderID
             
-            # 如果发生了成交
-            if buyCross or sellCross:
-                # 更新停止单状态，并从字典中删除该停止单
-                so.status = STOPORDER_TRIGGERED
-                if stopOrderID in self.workingStopOrderDict:
-                    del self.workingStopOrderDict[stopOrderID]                        
+            # 更新停止单状态，并从字典中删除该停止单
+            so.status = STOPORDER_TRIGGERED
+            if stopOrderID in working:
+                del working[stopOrderID]                        
 
-                # 推送成交数据
-                self.tradeCount += 1            # 成交编号自增1
-                tradeID = str(self.tradeCount)
-                trade = VtTradeData()
-                trade.vtSymbol = so.vtSymbol
-                trade.tradeID = tradeID
-                trade.vtTradeID = tradeID
-                
-                if buyCross:
-                    self.strategy.pos += so.volume
-                    trade.price = max(bestCrossPrice, so.price)
-                else:
-                    self.strategy.pos -= so.volume
-                    trade.price = min(bestCrossPrice, so.price)                
-                
-                self.limitOrderCount += 1
-                orderID = str(self.limitOrderCount)
-                trade.orderID = orderID
-                trade.vtOrderID = orderID
-                trade.direction = so.direction
-                trade.offset = so.offset
-                trade.volume = so.volume
-                trade.tradeTime = self.dt.strftime('%H:%M:%S')
-                trade.dt = self.dt
-                
-                self.tradeDict[tradeID] = trade
-                
-                # 推送委托数据
-                order = VtOrderData()
-                order.vtSymbol = so.vtSymbol
-                order.symbol = so.vtSymbol
-                order.orderID = orderID
-                order.vtOrderID = orderID
-                order.direction = so.direction
-                order.offset = so.offset
-                order.price = so.price
-                order.totalVolume = so.volume
-                order.tradedVolume = so.volume
-                order.status = STATUS_ALLTRADED
-                order.orderTime = trade.tradeTime
-                
-                self.limitOrderDict[orderID] = order
-                
-                # 按照顺序推送数据
-                self.strategy.onStopOrder(so)
-                self.strategy.onOrder(order)
-                self.strategy.onTrade(trade)
+            # 推送成交数据
+            self.tradeCount += 1            # 成交编号自增1
+            tradeID = str(self.tradeCount)
+            trade = VtTradeData()
+            trade.vtSymbol = so.vtSymbol
+            trade.tradeID = tradeID
+            trade.vtTradeID = tradeID
+            
+            if buyCross:
+                strategy.pos += so.volume
+                trade.price = max(bestCrossPrice, so.price)
+            else:
+                strategy.pos -= so.volume
+                trade.price = min(bestCrossPrice, so.price)                
+            
+            self.limitOrderCount += 1
+            orderID = str(self.limitOrderCount)
+            trade.orderID = orderID
+            trade.vtOrderID = orderID
+            trade.direction = so.direction
+            trade.offset = so.offset
+            trade.volume = so.volume
+            trade.tradeTime = tradeTime
+            trade.dt = dt
+            
+            self.tradeDict[tradeID] = trade
+            
+            # 推送委托数据
+            order = VtOrderData()
+            order.vtSymbol = so.vtSymbol
+            order.symbol = so.vtSymbol
+            order.orderID = orderID
+            order.vtOrderID = orderID
+            order.direction = so.direction
+            order.offset = so.offset
+            order.price = so.price
+            order.totalVolume = so.volume
+            order.tradedVolume = so.volume
+            order.status = STATUS_ALLTRADED
+            order.orderTime = trade.tradeTime
+            
+            self.limitOrderDict[orderID] = order
+            
+            # 按照顺序推送数据
+            strategy.onStopOrder(so)
+            strategy.onOrder(order)
+            strategy.onTrade(trade)
+        
+        # 清理堆中已经失效的停止单
+        if len(self.buyStopOrderHeap) + len(self.sellStopOrderHeap) > 2 * len(working) + 100:
+            self.buyStopOrderHeap = compactHeap(self.buyStopOrderHeap, working, 'stopOrderID')
+            self.sellStopOrderHeap = compactHeap(self.sellStopOrderHeap, working, 'stopOrderID')
     
     #------------------------------------------------
     # 策略接口相关
@@ -446,7 +584,7 @@ class BacktestingEngine(object):
         order.totalVolume = volume
         order.orderID = orderID
         order.vtOrderID = orderID
-        order.orderTime = self.dt.strftime('%H:%M:%S')
+        order.orderTime = self.dtTime
         
         # CTA委托类型映射
         if orderType == CTAORDER_BUY:
@@ -466,6 +604,14 @@ class BacktestingEngine(object):
         self.workingLimitOrderDict[orderID] = order
         self.limitOrderDict[orderID] = order
         
+        # 保存到价格堆中，用于撮合
+        seq = self.limitOrderCount
+        if order.direction == DIRECTION_LONG:
+            heapq.heappush(self.buyOrderHeap, (-order.price, seq, order))
+        elif order.direction == DIRECTION_SHORT:
+            heapq.heappush(self.sellOrderHeap, (order.price, seq, order))
+        self.newOrderList.append((seq, order))
+        
         return [orderID]
     
     #----------------------------------------------------------------------
@@ -475,7 +621,7 @@ class BacktestingEngine(object):
             order = self.workingLimitOrderDict[vtOrderID]
             
             order.status = STATUS_CANCELLED
-            order.cancelTime = self.dt.strftime('%H:%M:%S')
+            order.cancelTime = self.dtTime
             
             self.strategy.onOrder(order)
             
@@ -512,6 +658,13 @@ class BacktestingEngine(object):
         self.stopOrderDict[stopOrderID] = so
         self.workingStopOrderDict[stopOrderID] = so
         
+        # 保存到价格堆中，用于撮合
+        seq = self.stopOrderCount
+        if so.direction == DIRECTION_LONG:
+            heapq.heappush(self.buyStopOrderHeap, (so.price, seq, so))
+        elif so.direction == DIRECTION_SHORT:
+            heapq.heappush(self.sellStopOrderHeap, (-so.price, seq, so))
+        
         # 推送停止单初始更新
         self.strategy.onStopOrder(so)        
         
@@ -556,12 +709,12 @@ class BacktestingEngine(object):
     #----------------------------------------------------------------------
     def cancelAll(self, name):
         """全部撤单"""
-        # 撤销限价单
-        for orderID in self.workingLimitOrderDict.keys():
+        # 撤销限价单（撤单时会修改字典，因此先复制委托号）
+        for orderID in list(self.workingLimitOrderDict):
             self.cancelOrder(orderID)
         
         # 撤销停止单
-        for stopOrderID in self.workingStopOrderDict.keys():
+        for stopOrderID in list(self.workingStopOrderDict):
             self.cancelStopOrder(stopOrderID)
 
     #----------------------------------------------------------------------
@@ -578,173 +731,88 @@ class BacktestingEngine(object):
     def calculateBacktestingResult(self):
         """
         计算回测结果
+        返回结果字典，其中resultList为TradingResultList（不是list），支持len、下标、
+        切片和遍历，在访问时才生成TradingResult对象，需要普通列表时可以用list()转换
         """
         self.output(u'计算回测结果')
         
         # 首先基于回测后的成交记录，计算每笔交易的盈亏
-        resultList = []             # 交易结果列表
-        
-        longTrade = []              # 未平仓的多头交易
-        shortTrade = []             # 未平仓的空头交易
+        # 按照先进先出的规则配对开平仓成交，配对在数组上完成，
+        # 不需要复制和修改成交对象
+        tradeList = list(self.tradeDict.values())
+        volumeArray = np.array([trade.volume for trade in tradeList])
+        directionArray = np.array([DIRECTION_SIGN[trade.direction] for trade in tradeList])
         
-        tradeTimeList = []          # 每笔成交时间戳
-        posList = [0]               # 每笔成交后的持仓情况        
-
-        for trade in self.tradeDict.values():
-            # 复制成交对象，因为下面的开平仓交易配对涉及到对成交数量的修改
-            # 若不进行复制直接操作，则计算完后所有成交的数量会变成0
-            trade = copy.copy(trade)
-            
-            # 多头交易
-            if trade.direction == DIRECTION_LONG:
-                # 如果尚无空头交易
-                if not shortTrade:
-                    longTrade.append(trade)
-                # 当前多头交易为平空
-                else:
-                    while True:
-                        entryTrade = shortTrade[0]
-                        exitTrade = trade
-                        
-                        # 清算开平仓交易
-                        closedVolume = min(exitTrade.volume, entryTrade.volume)
-                        result = TradingResult(entryTrade.price, entryTrade.dt, 
-                                               exitTrade.price, exitTrade.dt,
-                                               -closedVolume, self.rate, self.slippage, self.size)
-                        resultList.append(result)
-                        
-                        posList.extend([-1,0])
-                        tradeTimeList.extend([result.entryDt, result.exitDt])
-                        
-                        # 计算未清算部分
-                        entryTrade.volume -= closedVolume
-                        exitTrade.volume -= closedVolume
-                        
-                        # 如果开仓交易已经全部清算，则从列表中移除
-                        if not entryTrade.volume:
-                            shortTrade.pop(0)
-                        
-                        # 如果平仓交易已经全部清算，则退出循环
-                        if not exitTrade.volume:
-                            break
-                        
-                        # 如果平仓交易未全部清算，
-                        if exitTrade.volume:
-                            # 且开仓交易已经全部清算完，则平仓交易剩余的部分
-                            # 等于新的反向开仓交易，添加到队列中
-                            if not shortTrade:
-                                longTrade.append(exitTrade)
-                                break
-                            # 如果开仓交易还有剩余，则进入下一轮循环
-                            else:
-                                pass
-                        
-            # 空头交易        
-            else:
-                # 如果尚无多头交易
-                if not longTrade:
-                    shortTrade.append(trade)
-                # 当前空头交易为平多
-                else:                    
-                    while True:
-                        entryTrade = longTrade[0]
-                        exitTrade = trade
-                        
-                        # 清算开平仓交易
-                        closedVolume = min(exitTrade.volume, entryTrade.volume)
-                        result = TradingResult(entryTrade.price, entryTrade.dt, 
-                                               exitTrade.price, exitTrade.dt,
-                                               closedVolume, self.rate, self.slippage, self.size)
-                        resultList.append(result)
-                        
-                        posList.extend([1,0])
-                        tradeTimeList.extend([result.entryDt, result.exitDt])
-
-                        # 计算未清算部分
-                        entryTrade.volume -= closedVolume
-                        exitTrade.volume -= closedVolume
-                        
-                        # 如果开仓交易已经全部清算，则从列表中移除
-                        if not entryTrade.volume:
-                            longTrade.pop(0)
-                        
-                        # 如果平仓交易已经全部清算，则退出循环
-                        if not exitTrade.volume:
-                            break
-                        
-                        # 如果平仓交易未全部清算，
-                        if exitTrade.volume:
-                            # 且开仓交易已经全部清算完，则平仓交易剩余的部分
-                            # 等于新的反向开仓交易，添加到队列中
-                            if not longTrade:
-                                shortTrade.append(exitTrade)
-                                break
-                            # 如果开仓交易还有剩余，则进入下一轮循环
-                            else:
-                                pass                    
+        entryIndex, exitIndex, matchVolume, openIndex, openVolume = matchTrades(volumeArray, 
+                                                                                directionArray)
         
         # 到最后交易日尚未平仓的交易，则以最后价格平仓
         if self.mode == self.BAR_MODE:
             endPrice = self.bar.close
         else:
             endPrice = self.tick.lastPrice
-            
-        for trade in longTrade:
-            result = TradingResult(trade.price, trade.dt, endPrice, self.dt, 
-                                   trade.volume, self.rate, self.slippage, self.size)
-            resultList.append(result)
-            
-        for trade in shortTrade:
-            result = TradingResult(trade.price, trade.dt, endPrice, self.dt, 
-                                   -trade.volume, self.rate, self.slippage, self.size)
-            resultList.append(result)            
         
-        # 检查是否有交易
-        if not resultList:
-            self.output(u'无交易结果')
-            return {}
-        
-        # 然后基于每笔交易的结果，我们可以计算具体的盈亏曲线和最大回撤等        
-        capital = 0             # 资金
-        maxCapital = 0          # 资金最高净值
-        drawdown = 0            # 回撤
+        # 每笔交易的开平仓数据按列保存，已配对的在前，以最后价格平仓的在后
+        closeCount = len(matchVolume)
+        openCount = len(openVolume)
         
-        totalResult = 0         # 总成交数量
-        totalTurnover = 0       # 总成交金额（合约面值）
-        totalCommission = 0     # 总手续费
-        totalSlippage = 0       # 总滑点
+        dtList = [trade.dt for trade in tradeList]
+        entryDtList = [dtList[i] for i in entryIndex.tolist() + openIndex.tolist()]
+        exitDtList = [dtList[i] for i in exitIndex.tolist()] + [self.dt] * openCount
         
-        timeList = []           # 时间序列
-        pnlList = []            # 每笔盈亏序列
-        capitalList = []        # 盈亏汇总的时间序列
-        drawdownList = []       # 回撤的时间序列
+        priceArray = np.array([trade.price for trade in tradeList], np.float64)
+        entryPriceArray = np.concatenate((priceArray[entryIndex], priceArray[openIndex]))
+        exitPriceArray = np.concatenate((priceArray[exitIndex], 
+                                         np.full(openCount, endPrice, np.float64)))
+        volumeArray = np.concatenate((matchVolume, openVolume))
         
-        winningResult = 0       # 盈利次数
-        losingResult = 0        # 亏损次数		
-        totalWinning = 0        # 总盈利金额		
-        totalLosing = 0         # 总亏损金额        
+        # 检查是否有交易
+        totalResult = closeCount + openCount    # 总成交数量
+        if not totalResult:
+            self.output(u'无交易结果')
+            return {}
         
-        for result in resultList:
-            capital += result.pnl
-            maxCapital = max(capital, maxCapital)
-            drawdown = capital - maxCapital
-            
-            pnlList.append(result.pnl)
-            timeList.append(result.exitDt)      # 交易的时间戳使用平仓时间
-            capitalList.append(capital)
-            drawdownList.append(drawdown)
-            
-            totalResult += 1
-            totalTurnover += result.turnover
-            totalCommission += result.commission
-            totalSlippage += result.slippage
-            
-            if result.pnl >= 0:
-                winningResult += 1
-                totalWinning += result.pnl
-            else:
-                losingResult += 1
-                totalLosing += result.pnl
+        # 每笔已配对交易开仓和平仓后的持仓情况，以及对应的时间戳
+        posArray = np.zeros(2 * closeCount + 1, np.int64)
+        posArray[1::2] = np.sign(matchVolume)
+        posList = posArray.tolist()
+        
+        tradeTimeList = [None] * (2 * closeCount)
+        tradeTimeList[0::2] = entryDtList[:closeCount]
+        tradeTimeList[1::2] = exitDtList[:closeCount]
+        
+        # 然后基于每笔交易的结果，我们可以计算具体的盈亏曲线和最大回撤等
+        # 在按列保存的数组上用numpy向量化计算，计算公式和TradingResult相同
+        absVolumeArray = np.abs(volumeArray)
+        turnoverArray = (entryPriceArray + exitPriceArray) * self.size * absVolumeArray
+        commissionArray = turnoverArray * self.rate
+        slippageArray = self.slippage * 2 * self.size * absVolumeArray
+        pnlArray = ((exitPriceArray - entryPriceArray) * volumeArray * self.size
+                    - commissionArray - slippageArray)
+        
+        capitalArray = np.cumsum(pnlArray)                              # 盈亏汇总的时间序列
+        maxCapitalArray = np.maximum(np.maximum.accumulate(capitalArray), 0)  # 资金最高净值（起始为0）
+        drawdownArray = capitalArray - maxCapitalArray                  # 回撤的时间序列
+        
+        capital = float(capitalArray[-1])           # 资金
+        maxCapital = float(maxCapitalArray[-1])     # 资金最高净值
+        drawdown = float(drawdownArray[-1])         # 回撤
+        maxDrawdown = float(drawdownArray.min())    # 最大回撤
+        
+        totalTurnover = float(turnoverArray.sum())      # 总成交金额（合约面值）
+        totalCommission = float(commissionArray.sum())  # 总手续费
+        totalSlippage = float(slippageArray.sum())      # 总滑点
+        
+        timeList = exitDtList                       # 时间序列，交易的时间戳使用平仓时间
+        pnlList = pnlArray.tolist()                 # 每笔盈亏序列
+        capitalList = capitalArray.tolist()
+        drawdownList = drawdownArray.tolist()
+        
+        winningMask = pnlArray >= 0
+        winningResult = int(winningMask.sum())                  # 盈利次数
+        losingResult = totalResult - winningResult              # 亏损次数
+        totalWinning = float(np.where(winningMask, pnlArray, 0).sum())  # 总盈利金额
+        totalLosing = float(np.where(winningMask, 0, pnlArray).sum())   # 总亏损金额
                 
         # 计算盈亏相关数据
         winningRate = winningResult/totalResult*100         # 胜率
@@ -765,6 +833,7 @@ class BacktestingEngine(object):
         d['capital'] = capital
         d['maxCapital'] = maxCapital
         d['drawdown'] = drawdown
+        d['maxDrawdown'] = maxDrawdown
         d['totalResult'] = totalResult
         d['totalTurnover'] = totalTurnover
         d['totalCommission'] = totalCommission
@@ -779,7 +848,9 @@ class BacktestingEngine(object):
         d['profitLossRatio'] = profitLossRatio
         d['posList'] = posList
         d['tradeTimeList'] = tradeTimeList
-        d['resultList'] = resultList
+        # 交易结果列表，只在访问时才生成TradingResult对象
+        d['resultList'] = TradingResultList(entryPriceArray, entryDtList, exitPriceArray, exitDtList,
+                                            volumeArray, self.rate, self.slippage, self.size)
         
         return d
         
@@ -795,7 +866,7 @@ class BacktestingEngine(object):
         
         self.output(u'总交易次数：\t%s' % formatNumber(d['totalResult']))        
         self.output(u'总盈亏：\t%s' % formatNumber(d['capital']))
-        self.output(u'最大回撤: \t%s' % formatNumber(min(d['drawdownList'])))                
+        self.output(u'最大回撤: \t%s' % formatNumber(d['maxDrawdown']))                
         
         self.output(u'平均每笔盈利：\t%s' %formatNumber(d['capital']/d['totalResult']))
         self.output(u'平均每笔滑点：\t%s' %formatNumber(d['totalSlippage']/d['totalResult']))
@@ -807,7 +878,10 @@ class BacktestingEngine(object):
         self.output(u'盈亏比：\t%s' %formatNumber(d['profitLossRatio']))
     
         # 绘图
-        fig = plt.figure(figsize=(10, 16))
+        plt = importPyplot()
+        # 按名称复用同一个图表，多次调用时不会不断创建新的图表
+        fig = plt.figure('Backtesting Result', figsize=(10, 16))
+        fig.clf()
         
         pCapital = plt.subplot(4, 1, 1)
         pCapital.set_ylabel("capital")
@@ -825,9 +899,10 @@ class BacktestingEngine(object):
         pPos.set_ylabel("Position")
         if d['posList'][-1] == 0:
             del d['posList'][-1]
-        tradeTimeIndex = [item.strftime("%m/%d %H:%M:%S") for item in d['tradeTimeList']]
-        xindex = np.arange(0, len(tradeTimeIndex), np.int(len(tradeTimeIndex)/10))
-        tradeTimeIndex = map(lambda i: tradeTimeIndex[i], xindex)
+        # 只对实际显示的刻度格式化时间
+        tradeTimeList = d['tradeTimeList']
+        xindex = np.arange(0, len(tradeTimeList), max(1, len(tradeTimeList)//10))
+        tradeTimeIndex = [tradeTimeList[i].strftime("%m/%d %H:%M:%S") for i in xindex]
         pPos.plot(d['posList'], color='k', drawstyle='steps-pre')
         pPos.set_ylim(-1.2, 1.2)
         plt.sca(pPos)
@@ -843,16 +918,29 @@ class BacktestingEngine(object):
         self.limitOrderCount = 0
         self.limitOrderDict.clear()
         self.workingLimitOrderDict.clear()        
+        self.buyOrderHeap = []
+        self.sellOrderHeap = []
+        self.newOrderList = []
         
         # 清空停止单相关
         self.stopOrderCount = 0
         self.stopOrderDict.clear()
         self.workingStopOrderDict.clear()
+        self.buyStopOrderHeap = []
+        self.sellStopOrderHeap = []
         
         # 清空成交相关
         self.tradeCount = 0
         self.tradeDict.clear()
         
+        # 清空最新数据和日线结果
+        self.tick = None
+        self.bar = None
+        self.dt = None
+        self.dtTime = ''
+        self.dailyResultDict.clear()
+        self.dailyResult = None
+        
     #----------------------------------------------------------------------
     def runOptimization(self, strategyClass, optimizationSetting):
         """优化参数"""
@@ -864,16 +952,30 @@ class BacktestingEngine(object):
         if not settingList or not targetName:
             self.output(u'优化设置有问题，请检查')
         
-        # 遍历优化
+        # 遍历优化，启用了参数缓存时，策略实际生效参数相同的设置直接使用之前的回测结果
+        paramCache = optimizationSetting.paramCache
         resultList = []
+        resultCache = {}
         for setting in settingList:
             self.clearBacktestingResult()
             self.output('-' * 30)
             self.output('setting: %s' %str(setting))
             self.initStrategy(strategyClass, setting)
-            self.runBacktesting()
-            df = self.calculateDailyResult()
-            df, d = self.calculateDailyStatistics(df)            
+            
+            paramKey = None
+            if paramCache:
+                paramKey = getParamKey(self.strategy)
+            
+            if paramKey is not None and paramKey in resultCache:
+                d = resultCache[paramKey]
+            else:
+                self.runBacktesting()
+                df = self.calculateDailyResult()
+                df, d = self.calculateDailyStatistics(df)
+                
+                if paramKey is not None:
+                    resultCache[paramKey] = d
+            
             try:
                 targetValue = d[targetName]
             except KeyError:
@@ -899,21 +1001,18 @@ class BacktestingEngine(object):
         if not settingList or not targetName:
             self.output(u'优化设置有问题，请检查')
         
-        # 多进程优化，启动一个对应CPU核心数量的进程池
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        l = []
-
-        for setting in settingList:
-            l.append(pool.apply_async(optimize, (strategyClass, setting,
-                                                 targetName, self.mode, 
-                                                 self.startDate, self.initDays, self.endDate,
-                                                 self.slippage, self.rate, self.size, self.priceTick,
-                                                 self.dbName, self.symbol)))
-        pool.close()
-        pool.join()
+        # 多进程优化，启动一个对应CPU核心数量的进程池，
+        # 引擎设置和历史数据在进程初始化时传入，每个任务只需传递参数设置
+        resultList = []
+        for setting, d in self.runParallel(strategyClass, settingList, 
+                                           paramCache=optimizationSetting.paramCache):
+            try:
+                targetValue = d[targetName]
+            except KeyError:
+                targetValue = 0
+            resultList.append((setting, targetValue, d))
         
         # 显示结果
-        resultList = [res.get() for res in l]
         resultList.sort(reverse=True, key=lambda result:result[1])
         self.output('-' * 30)
         self.output(u'优化结果：')
@@ -921,45 +1020,113 @@ class BacktestingEngine(object):
             self.output(u'参数：%s，目标：%s' %(result[0], result[1]))    
             
         return resultList
+    
+    #----------------------------------------------------------------------
+    def getHistoryArray(self):
+        """
+        将历史数据打包为结构化数组，用于在进程间共享
+        返回(packHistoryData打包的数据, 初始化数据数量)
+        """
+        if self.historyData is not None:
+            return self.historyData
+        
+        if self.backtestData is None:
+            self.loadHistoryData()
+            backtestList = list(self.dbCursor)
+        else:
+            backtestList = [data.__dict__ for data in self.backtestData]
+        
+        initList = [data.__dict__ for data in self.initData]
+        
+        return packHistoryData(initList + backtestList), len(initList)
+    
+    #----------------------------------------------------------------------
+    def runParallel(self, strategyClass, settingList, workers=None, paramCache=False):
+        """
+        多进程并行运行多组参数的回测，返回每组参数的按日统计结果
+        历史数据只在主进程中载入一次，通过共享内存提供给所有子进程
+        paramCache：策略实际生效参数相同的设置是否复用同一子进程中之前的回测结果
+        返回(参数字符串, 统计结果字典)的列表，按回测完成的先后排列
+        """
+        engineSetting = {
+            'mode': self.mode,
+            'startDate': self.startDate,
+            'initDays': self.initDays,
+            'endDate': self.endDate,
+            'capital': self.capital,
+            'slippage': self.slippage,
+            'rate': self.rate,
+            'size': self.size,
+            'priceTick': self.priceTick,
+            'dbName': self.dbName,
+            'symbol': self.symbol,
+            'paramCache': paramCache
+        }
+        
+        # 历史数据复制到共享内存中，子进程直接读取，不再各自访问数据库
+        history, initCount = self.getHistoryArray()
+        array = history[0]
+        raw = multiprocessing.RawArray('b', max(array.nbytes, 1))
+        if array.nbytes:
+            np.frombuffer(raw, dtype=array.dtype, count=len(array))[:] = array
+        sharedData = (raw, array.dtype, len(array)) + history[1:] + (initCount,)
+        del array, history      # 主进程中只保留共享内存中的一份数据
+        
+        workers = workers or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(workers,
+                                    initializer=initParallelWorker,
+                                    initargs=(strategyClass, engineSetting, sharedData))
+        
+        # 每个进程一次领取多组参数，减少进程间通信的次数，
+        # 结果按完成顺序逐批返回，不必等待全部参数回测结束即可输出进度
+        total = len(settingList)
+        chunksize = max(1, total // (4 * workers))
+        resultList = []
+        for setting, d in pool.imap_unordered(runParallelWorker, settingList, chunksize):
+            resultList.append((setting, d))
+            self.output(u'回测进度：%s/%s，参数：%s' %(len(resultList), total, setting))
+        pool.close()
+        pool.join()
+        
+        return resultList
 
     #----------------------------------------------------------------------
     def updateDailyClose(self, dt, price):
         """更新每日收盘价"""
         date = dt.date()
         
-        if date not in self.dailyResultDict:
-            self.dailyResultDict[date] = DailyResult(date, price)
+        dailyResult = self.dailyResultDict.get(date)
+        
+        if dailyResult is None:
+            dailyResult = DailyResult(date, price)
+            self.dailyResultDict[date] = dailyResult
         else:
-            self.dailyResultDict[date].closePrice = price
+            dailyResult.closePrice = price
+        
+        self.dailyResult = dailyResult
             
     #----------------------------------------------------------------------
     def calculateDailyResult(self):
         """计算按日统计的交易结果"""
         self.output(u'计算按日统计结果')
         
+        dailyResultDict = self.dailyResultDict
+        dailyResultList = list(dailyResultDict.values())
+        
         # 将成交添加到每日交易结果中
+        dateIndex = {}
+        for i, dailyResult in enumerate(dailyResultList):
+            dailyResult.tradeList = []
+            dateIndex[dailyResult.date] = i
+        
         for trade in self.tradeDict.values():
-            date = trade.dt.date()
-            dailyResult = self.dailyResultDict[date]
-            dailyResult.addTrade(trade)
-            
-        # 遍历计算每日结果
-        previousClose = 0
-        openPosition = 0
-        for dailyResult in self.dailyResultDict.values():
-            dailyResult.previousClose = previousClose
-            previousClose = dailyResult.closePrice
-            
-            dailyResult.calculatePnl(openPosition, self.size, self.rate, self.slippage )
-            openPosition = dailyResult.closePosition
-            
-        # 生成DataFrame
-        resultDict = {k:[] for k in dailyResult.__dict__.keys()}
-        for dailyResult in self.dailyResultDict.values():
-            for k, v in dailyResult.__dict__.items():
-                resultDict[k].append(v)
-                
-        resultDf = pd.DataFrame.from_dict(resultDict)
+            dailyResultList[dateIndex[trade.dt.date()]].addTrade(trade)
+        
+        # 所有日期一起批量计算盈亏
+        resultDict = DailyResult.calculateBatchPnl(dailyResultList, self.size, 
+                                                   self.rate, self.slippage)
+        
+        resultDf = pd.DataFrame(resultDict)
         
         # 计算衍生数据
         resultDf = resultDf.set_index('date')
@@ -969,43 +1136,57 @@ class BacktestingEngine(object):
     #----------------------------------------------------------------------
     def calculateDailyStatistics(self, df):
         """计算按日统计的结果"""
-        df['balance'] = df['netPnl'].cumsum() + self.capital
-        df['return'] = (np.log(df['balance']) - np.log(df['balance'].shift(1))).fillna(0)
-        df['highlevel'] = df['balance'].rolling(min_periods=1,window=len(df),center=False).max()
-        df['drawdown'] = df['balance'] - df['highlevel']        
-        df['ddPercent'] = df['drawdown'] / df['highlevel'] * 100
+        balance = np.cumsum(df['netPnl'].values) + self.capital
+        
+        # 对数收益率，只计算一次对数，第一日（以及无法计算的日期）收益率为0
+        logBalance = np.log(balance)
+        dailyReturnArray = np.zeros(len(balance))
+        dailyReturnArray[1:] = logBalance[1:] - logBalance[:-1]
+        dailyReturnArray[np.isnan(dailyReturnArray)] = 0
+        
+        highlevel = np.maximum.accumulate(balance)      # 历史最高净值即累计最大值
+        drawdown = balance - highlevel
+        
+        df['balance'] = balance
+        df['return'] = dailyReturnArray
+        df['highlevel'] = highlevel
+        df['drawdown'] = drawdown
+        df['ddPercent'] = drawdown / highlevel * 100
         
         # 计算统计结果
         startDate = df.index[0]
         endDate = df.index[-1]
 
+        # 直接在数组上统计，避免生成过滤后的DataFrame
+        netPnl = df['netPnl'].values
+        
         totalDays = len(df)
-        profitDays = len(df[df['netPnl']>0])
-        lossDays = len(df[df['netPnl']<0])
+        profitDays = int((netPnl > 0).sum())
+        lossDays = int((netPnl < 0).sum())
         
-        endBalance = df['balance'].iloc[-1]
-        maxDrawdown = df['drawdown'].min()
-        maxDdPercent = df['ddPercent'].min()
+        endBalance = balance[-1]
+        maxDrawdown = drawdown.min()
+        maxDdPercent = np.nanmin(df['ddPercent'].values)
         
-        totalNetPnl = df['netPnl'].sum()
+        totalNetPnl = netPnl.sum()
         dailyNetPnl = totalNetPnl / totalDays
         
-        totalCommission = df['commission'].sum()
+        totalCommission = df['commission'].values.sum()
         dailyCommission = totalCommission / totalDays
         
-        totalSlippage = df['slippage'].sum()
+        totalSlippage = df['slippage'].values.sum()
         dailySlippage = totalSlippage / totalDays
         
-        totalTurnover = df['turnover'].sum()
+        totalTurnover = df['turnover'].values.sum()
         dailyTurnover = totalTurnover / totalDays
         
-        totalTradeCount = df['tradeCount'].sum()
+        totalTradeCount = df['tradeCount'].values.sum()
         dailyTradeCount = totalTradeCount / totalDays
         
         totalReturn = (endBalance/self.capital - 1) * 100
         annualizedReturn = totalReturn / totalDays * 240
-        dailyReturn = df['return'].mean() * 100
-        returnStd = df['return'].std() * 100
+        dailyReturn = dailyReturnArray.mean() * 100
+        returnStd = dailyReturnArray.std(ddof=1) * 100
         
         if returnStd:
             sharpeRatio = dailyReturn / returnStd * np.sqrt(240)
@@ -1082,7 +1263,9 @@ class BacktestingEngine(object):
         self.output(u'Sharpe Ratio：\t%s' % formatNumber(result['sharpeRatio']))
         
         # 绘图
-        fig = plt.figure(figsize=(10, 16))
+        plt = importPyplot()
+        fig = plt.figure('Daily Result', figsize=(10, 16))
+        fig.clf()
         
         pBalance = plt.subplot(4, 1, 1)
         pBalance.set_title('Balance')
@@ -1106,6 +1289,9 @@ class BacktestingEngine(object):
 ########################################################################
 class TradingResult(object):
     """每笔交易的结果"""
+    
+    __slots__ = ('entryPrice', 'exitPrice', 'entryDt', 'exitDt', 'volume',
+                 'turnover', 'commission', 'slippage', 'pnl')
 
     #----------------------------------------------------------------------
     def __init__(self, entryPrice, entryDt, exitPrice, 
@@ -1118,17 +1304,77 @@ class TradingResult(object):
         self.exitDt = exitDt            # 平仓时间
         
         self.volume = volume    # 交易数量（+/-代表方向）
+        absVolume = abs(volume)
+        
+        self.turnover = (entryPrice+exitPrice)*size*absVolume   # 成交金额
+        self.commission = self.turnover*rate                    # 手续费成本
+        self.slippage = slippage*2*size*absVolume               # 滑点成本
+        self.pnl = ((exitPrice - entryPrice) * volume * size 
+                    - self.commission - self.slippage)          # 净盈亏
+
+
+########################################################################
+class TradingResultList(object):
+    """
+    按列保存的每笔交易结果，只在访问时才生成对应的TradingResult对象，
+    回测统计直接在数组上计算，不需要逐笔创建对象
+    支持len、下标、遍历，切片和相加返回普通列表；
+    不是list的子类，每次访问都会生成新的TradingResult对象，对其修改不会保留
+    """
+
+    #----------------------------------------------------------------------
+    def __init__(self, entryPriceArray, entryDtList, exitPriceArray, 
+                 exitDtList, volumeArray, rate, slippage, size):
+        """Constructor"""
+        self.entryPriceArray = entryPriceArray      # 开仓价格数组
+        self.entryDtList = entryDtList              # 开仓时间列表
+        self.exitPriceArray = exitPriceArray        # 平仓价格数组
+        self.exitDtList = exitDtList                # 平仓时间列表
+        self.volumeArray = volumeArray              # 交易数量数组（+/-代表方向）
         
-        self.turnover = (self.entryPrice+self.exitPrice)*size*abs(volume)   # 成交金额
-        self.commission = self.turnover*rate                                # 手续费成本
-        self.slippage = slippage*2*size*abs(volume)                         # 滑点成本
-        self.pnl = ((self.exitPrice - self.entryPrice) * volume * size 
-                    - self.commission - self.slippage)                      # 净盈亏
+        self.rate = rate
+        self.slippage = slippage
+        self.size = size
+    
+    #----------------------------------------------------------------------
+    def __len__(self):
+        """交易数量"""
+        return len(self.volumeArray)
+    
+    #----------------------------------------------------------------------
+    def __getitem__(self, i):
+        """生成第i笔交易的结果对象，支持切片"""
+        if isinstance(i, slice):
+            return [self[n] for n in range(*i.indices(len(self)))]
+        
+        return TradingResult(float(self.entryPriceArray[i]), self.entryDtList[i],
+                             float(self.exitPriceArray[i]), self.exitDtList[i],
+                             self.volumeArray[i].item(), self.rate, self.slippage, self.size)
+    
+    #----------------------------------------------------------------------
+    def __iter__(self):
+        """逐笔生成交易结果对象"""
+        for i in range(len(self)):
+            yield self[i]
+    
+    #----------------------------------------------------------------------
+    def __add__(self, other):
+        """和其他列表相加，返回普通列表"""
+        return list(self) + list(other)
+    
+    #----------------------------------------------------------------------
+    def __radd__(self, other):
+        """和其他列表相加，返回普通列表"""
+        return list(other) + list(self)
 
 
 ########################################################################
 class DailyResult(object):
     """每日交易的结果"""
+    
+    __slots__ = ('date', 'closePrice', 'previousClose', 'tradeList', 'tradeCount',
+                 'openPosition', 'closePosition', 'tradingPnl', 'positionPnl', 'totalPnl',
+                 'turnover', 'commission', 'slippage', 'netPnl')
 
     #----------------------------------------------------------------------
     def __init__(self, date, closePrice):
@@ -1158,36 +1404,72 @@ class DailyResult(object):
         self.tradeList.append(trade)
 
     #----------------------------------------------------------------------
-    def calculatePnl(self, openPosition=0, size=1, rate=0, slippage=0):
+    @staticmethod
+    def calculateBatchPnl(dailyResultList, size=1, rate=0, slippage=0):
         """
-        计算盈亏
+        批量计算连续多日的盈亏
+        dailyResultList：按日期排序的每日结果列表，昨收和开盘持仓由前一日结果得到，
+                         第一日使用其自身的昨收，开盘持仓为0
         size: 合约乘数
         rate：手续费率
         slippage：滑点点数
+        返回按列保存计算结果的有序字典，同时写回每日结果对象中
         """
-        # 持仓部分
-        self.openPosition = openPosition
-        self.positionPnl = self.openPosition * (self.closePrice - self.previousClose) * size
-        self.closePosition = self.openPosition
-        
-        # 交易部分
-        self.tradeCount = len(self.tradeList)
-        
-        for trade in self.tradeList:
-            if trade.direction == DIRECTION_LONG:
-                posChange = trade.volume
-            else:
-                posChange = -trade.volume
-                
-            self.tradingPnl += posChange * (self.closePrice - trade.price) * size
-            self.closePosition += posChange
-            self.turnover += trade.price * trade.volume * size
-            self.commission += trade.price * trade.volume * size * rate
-            self.slippage += trade.volume * size * slippage
-        
-        # 汇总
-        self.totalPnl = self.tradingPnl + self.positionPnl
-        self.netPnl = self.totalPnl - self.commission - self.slippage
+        dayCount = len(dailyResultList)
+        
+        closeArray = np.array([dailyResult.closePrice for dailyResult in dailyResultList], np.float64)
+        previousCloseArray = np.empty(dayCount)
+        previousCloseArray[1:] = closeArray[:-1]
+        if dayCount:
+            previousCloseArray[0] = dailyResultList[0].previousClose
+        
+        # 所有成交按日期顺序排成一列，同时记录每笔成交所属日期的序号
+        tradeCount = np.array([len(dailyResult.tradeList) for dailyResult in dailyResultList], np.int64)
+        dayArray = np.repeat(np.arange(dayCount), tradeCount)
+        tradeList = [trade for dailyResult in dailyResultList for trade in dailyResult.tradeList]
+        
+        priceArray, volumeArray, signArray = getTradeArrays(tradeList)
+        posChangeArray = signArray * volumeArray
+        
+        # np.bincount按成交顺序把每笔成交的数值累加到所属日期上
+        dayPosChange = np.bincount(dayArray, posChangeArray, dayCount)
+        closePosition = np.cumsum(dayPosChange)
+        openPosition = closePosition - dayPosChange
+        
+        positionPnl = openPosition * (closeArray - previousCloseArray) * size
+        # 合约乘数等常数因子在按日汇总之后再乘，避免在每笔成交上重复计算
+        tradingPnl = np.bincount(dayArray, posChangeArray * (closeArray[dayArray] - priceArray), 
+                                 dayCount) * size
+        turnover = np.bincount(dayArray, priceArray * volumeArray, dayCount) * size
+        commission = turnover * rate
+        slippage = np.bincount(dayArray, volumeArray, dayCount) * (size * slippage)
+        totalPnl = tradingPnl + positionPnl
+        netPnl = totalPnl - commission - slippage
+        
+        # 按列保存结果
+        resultDict = OrderedDict()
+        resultDict['date'] = [dailyResult.date for dailyResult in dailyResultList]
+        resultDict['closePrice'] = closeArray
+        resultDict['previousClose'] = previousCloseArray
+        resultDict['tradeList'] = [dailyResult.tradeList for dailyResult in dailyResultList]
+        resultDict['tradeCount'] = tradeCount
+        resultDict['openPosition'] = openPosition
+        resultDict['closePosition'] = closePosition
+        resultDict['tradingPnl'] = tradingPnl
+        resultDict['positionPnl'] = positionPnl
+        resultDict['totalPnl'] = totalPnl
+        resultDict['turnover'] = turnover
+        resultDict['commission'] = commission
+        resultDict['slippage'] = slippage
+        resultDict['netPnl'] = netPnl
+        
+        # 计算结果同时写回每日结果对象中
+        columns = [(k, v.tolist()) for k, v in resultDict.items() if isinstance(v, np.ndarray)]
+        for i, dailyResult in enumerate(dailyResultList):
+            for k, values in columns:
+                setattr(dailyResult, k, values[i])
+        
+        return resultDict
 
 
 ########################################################################
@@ -1200,6 +1482,7 @@ class OptimizationSetting(object):
         self.paramDict = OrderedDict()
         
         self.optimizeTarget = ''        # 优化目标字段
+        self.paramCache = False         # 策略实际生效参数相同的设置是否复用之前的回测结果
         
     #----------------------------------------------------------------------
     def addParameter(self, name, start, end=None, step=None):
@@ -1216,45 +1499,400 @@ class OptimizationSetting(object):
             print u'参数布进必须大于0'
             return
         
-        l = []
-        param = start
+        # 按数量一次生成参数序列，避免逐次累加步进带来的浮点误差导致漏掉终止点，
+        # 整数参数生成的仍然是整数
+        count = int(np.floor((end - start) / step + 1e-9)) + 1
+        self.paramDict[name] = (start + np.arange(count) * step).tolist()
         
-        while param <= end:
-            l.append(param)
-            param += step
-        
-        self.paramDict[name] = l
+    #----------------------------------------------------------------------
+    def iterSetting(self):
+        """逐个生成优化参数组合，不在内存中展开全部组合"""
+        # 参数名的列表
+        nameList = tuple(self.paramDict.keys())
+        paramList = tuple(self.paramDict.values())
         
+        # 使用迭代工具生产参数对组合，逐个打包成字典
+        return (dict(zip(nameList, p)) for p in product(*paramList))
+    
     #----------------------------------------------------------------------
     def generateSetting(self):
         """生成优化参数组合"""
-        # 参数名的列表
-        nameList = self.paramDict.keys()
-        paramList = self.paramDict.values()
-        
-        # 使用迭代工具生产参数对组合
-        productList = list(product(*paramList))
-        
         # 把参数对组合打包到一个个字典组成的列表中
-        settingList = []
-        for p in productList:
-            d = dict(zip(nameList, p))
-            settingList.append(d)
-    
-        return settingList
+        return list(self.iterSetting())
     
     #----------------------------------------------------------------------
     def setOptimizeTarget(self, target):
         """设置优化目标字段"""
         self.optimizeTarget = target
+        
+    #----------------------------------------------------------------------
+    def setParamCache(self, paramCache):
+        """
+        设置是否复用回测结果，启用后策略paramList中参数的实际值相同的设置只回测一次，
+        仅适用于策略行为只取决于paramList中参数的情况
+        """
+        self.paramCache = paramCache
+
 
+# 加上千分符的格式化函数，预先绑定避免每次调用时查找
+formatThousands = '{:,}'.format
 
 #----------------------------------------------------------------------
 def formatNumber(n):
     """格式化数字到字符串"""
-    rn = round(n, 2)        # 保留两位小数
-    return format(rn, ',')  # 加上千分符
+    return formatThousands(round(n, 2))     # 保留两位小数，加上千分符
+    
+
+#----------------------------------------------------------------------
+def matchTrades(volumeArray, directionArray):
+    """
+    按照先进先出的规则配对开平仓成交
+    volumeArray：每笔成交的数量
+    directionArray：每笔成交的方向，多头为1，空头为-1
+    返回(开仓成交序号, 平仓成交序号, 配对数量, 未平仓成交序号, 未平仓数量)，
+    数量的+/-代表开仓方向，配对按照平仓成交的顺序排列
+    """
+    # 与当前持仓方向相反的成交先平仓，剩余部分为反向开仓
+    signedVolume = volumeArray * directionArray
+    posAfter = np.cumsum(signedVolume)
+    posBefore = posAfter - signedVolume
+    closeVolume = np.where(posBefore * directionArray < 0, 
+                           np.minimum(volumeArray, np.abs(posBefore)), 0)
+    openVolume = volumeArray - closeVolume
+    
+    entryList = []
+    exitList = []
+    matchList = []
+    leftList = []
+    leftVolumeList = []
+    
+    # 多头和空头分别配对，先进先出意味着第n手平仓对应第n手开仓，
+    # 开仓和平仓数量的累计值一起切分出的每一段即为一组配对
+    for direction in (1, -1):
+        openIndex = np.flatnonzero((directionArray == direction) & (openVolume > 0))
+        closeIndex = np.flatnonzero((directionArray == -direction) & (closeVolume > 0))
+        openEnd = np.cumsum(openVolume[openIndex])
+        closeEnd = np.cumsum(closeVolume[closeIndex])
+        closedTotal = closeEnd[-1] if len(closeEnd) else 0
+        
+        end = np.union1d(openEnd[openEnd < closedTotal], closeEnd)
+        start = np.concatenate(([0], end))[:-1]
+        
+        entryList.append(openIndex[np.searchsorted(openEnd, start, 'right')])
+        exitList.append(closeIndex[np.searchsorted(closeEnd, start, 'right')])
+        matchList.append((end - start) * direction)
+        
+        # 超出平仓总量的部分为未平仓
+        left = openEnd > closedTotal
+        openStart = openEnd - openVolume[openIndex]
+        leftList.append(openIndex[left])
+        leftVolumeList.append((openEnd[left] - np.maximum(openStart[left], closedTotal)) * direction)
+    
+    # 合并多空两边的配对，按照平仓成交的顺序排列（稳定排序保持同一平仓成交内的顺序）
+    entryIndex = np.concatenate(entryList)
+    exitIndex = np.concatenate(exitList)
+    matchVolume = np.concatenate(matchList)
+    order = np.argsort(exitIndex, kind='mergesort')
+    
+    return (entryIndex[order], exitIndex[order], matchVolume[order],
+            np.concatenate(leftList), np.concatenate(leftVolumeList))
+
+
+#----------------------------------------------------------------------
+def getTradeArrays(tradeList):
+    """
+    遍历一次成交列表，将成交对象中计算用的字段按列提取为数组
+    返回(价格数组, 数量数组, 方向数组)，方向数组中多头为1，空头为-1
+    """
+    tradeArray = np.array([(trade.price, trade.volume, DIRECTION_SIGN[trade.direction]) 
+                           for trade in tradeList], np.float64).reshape(-1, 3)
+    
+    priceArray = tradeArray[:, 0]
+    volumeArray = tradeArray[:, 1]
+    signArray = tradeArray[:, 2]
+    return priceArray, volumeArray, signArray
+
+#----------------------------------------------------------------------
+def getParamKey(strategy):
+    """
+    获取策略初始化后实际生效的参数组合，用于识别回测结果相同的参数设置
+    （设置中不在paramList里的参数会被策略忽略），参数值无法哈希时返回None
+    """
+    paramKey = tuple(getattr(strategy, name, None) for name in strategy.paramList)
+    
+    try:
+        hash(paramKey)
+    except TypeError:
+        return None
+    
+    return paramKey
+
+#----------------------------------------------------------------------
+def importPyplot():
+    """载入matplotlib绘图模块，只在绘图时才载入以减少回测和优化进程的启动时间"""
+    import matplotlib.pyplot as plt
+    
+    # 如果安装了seaborn则设置为白色风格
+    try:
+        import seaborn as sns       
+        sns.set_style('whitegrid')  
+    except ImportError:
+        pass
+    
+    return plt
+
+
+#----------------------------------------------------------------------
+def compactHeap(heap, workingDict, idName):
+    """从委托价格堆中移除已经不在活动字典中的委托，返回新的堆"""
+    heap = [item for item in heap if getattr(item[2], idName) in workingDict]
+    heapq.heapify(heap)
+    return heap
+
+
+#----------------------------------------------------------------------
+def iterData(cursor, dataClass):
+    """逐条将数据库记录转换为数据对象（惰性生成，不缓存整个结果集）"""
+    for d in cursor:
+        # 字段全部来自数据库记录，因此跳过__init__中的默认值初始化
+        data = dataClass.__new__(dataClass)
+        data.__dict__ = d
+        yield data
+    
+
+#----------------------------------------------------------------------
+def packHistoryData(recordList):
+    """
+    将历史数据记录（字典）列表打包为结构化数组，用于在进程间共享，每个字段保持原有的类型：
+    1. 所有记录中都相同的字段保存在常量字典中
+    2. 类型统一的整数、浮点、布尔、时间和字符串字段保存在结构化数组中
+    3. 其他字段（如多种类型混合）保存在对象字典中，每个字段一个列表
+    含有None或者在部分记录中缺失的字段，在结构化数组中额外保存每条记录的字段状态
+    返回(结构化数组, 字段列表, 常量字典, 对象字典)，
+    字段列表中每项为(字段名, 数组中的值字段名, 数组中的状态字段名)，没有对应字段时为None
+    """
+    # 按首次出现的顺序收集所有字段名
+    nameList = []
+    nameSet = set()
+    for d in recordList:
+        for name in d:
+            if name not in nameSet:
+                nameSet.add(name)
+                nameList.append(name)
+    
+    missing = object()      # 记录中缺失字段的标记
+    
+    fieldList = []
+    constDict = {}
+    objectDict = {}
+    dtypeList = []
+    arrayDict = {}
+    
+    for n, name in enumerate(nameList):
+        values = [d.get(name, missing) for d in recordList]
+        stateList = [FIELD_MISSING if v is missing else FIELD_NONE if v is None else FIELD_VALUE 
+                     for v in values]
+        presentList = [v for v, state in zip(values, stateList) if state == FIELD_VALUE]
+        
+        # 所有记录中值和类型都相同的字段，可变对象每条记录需要单独的一份，不作为常量
+        first = values[0]
+        if (first is not missing and not isinstance(first, (list, dict)) and 
+            all(v == first and type(v) is type(first) for v in values)):
+            constDict[name] = first
+            continue
+        
+        valueField = None
+        stateField = None
+        
+        if len(presentList) < len(values):
+            stateField = 's%d' %n
+            dtypeList.append((stateField, np.int8))
+            arrayDict[stateField] = stateList
+        
+        if presentList:
+            dtype = getFieldDtype(presentList)
+            
+            if dtype is None:
+                objectDict[name] = [None if v is missing else v for v in values]
+            else:
+                valueField = 'v%d' %n
+                dtypeList.append((valueField, dtype))
+                # None和缺失的位置填入同类型的值，还原时由状态字段区分
+                arrayDict[valueField] = [v if state == FIELD_VALUE else presentList[0] 
+                                         for v, state in zip(values, stateList)]
+        
+        fieldList.append((name, valueField, stateField))
+    
+    array = np.empty(len(recordList), dtype=dtypeList)
+    for field, values in arrayDict.items():
+        array[field] = values
+    
+    return array, fieldList, constDict, objectDict
+
+
+#----------------------------------------------------------------------
+def getFieldDtype(valueList):
+    """获取可以无损保存字段值的numpy类型，无法保存时返回None"""
+    typeSet = set(type(v) for v in valueList)
+    if len(typeSet) != 1:
+        return None
+    
+    valueType = typeSet.pop()
+    
+    if valueType is float:
+        return np.float64
+    
+    if valueType is bool:
+        return np.bool_
+    
+    if valueType is int:
+        return np.int64
+    
+    # 只支持不带时区的时间
+    if valueType is datetime and all(v.tzinfo is None for v in valueList):
+        return 'datetime64[us]'
+    
+    # numpy会去掉字符串末尾的空字符，这样的字符串无法还原
+    if valueType in (str, unicode):
+        if any(v.endswith('\0') for v in valueList):
+            return None
+        
+        length = max(max(len(v) for v in valueList), 1)
+        if valueType is str:
+            return 'S%d' %length
+        return 'U%d' %length
+    
+    return None
+
+
+#----------------------------------------------------------------------
+def iterHistoryData(history, start, end, dataClass, blockSize=10000):
+    """
+    从packHistoryData打包的数据中逐条生成数据对象（惰性生成），
+    每次只将一段记录转换为Python原生类型
+    """
+    array, fieldList, constDict, objectDict = history
     
+    for blockStart in range(start, end, blockSize):
+        blockEnd = min(blockStart + blockSize, end)
+        block = array[blockStart:blockEnd]
+        count = blockEnd - blockStart
+        
+        # 没有状态的字段直接打包，有状态的字段逐条判断
+        nameList = []
+        columnList = []
+        stateColumnList = []
+        
+        for name, valueField, stateField in fieldList:
+            if valueField:
+                values = toPyList(block[valueField])
+            elif name in objectDict:
+                values = objectDict[name][blockStart:blockEnd]
+            else:
+                values = [None] * count
+            
+            if stateField:
+                stateColumnList.append((name, values, block[stateField].tolist()))
+            else:
+                nameList.append(name)
+                columnList.append(values)
+        
+        for i, row in enumerate(zip(*columnList) if columnList else [()] * count):
+            d = dict(zip(nameList, row))
+            d.update(constDict)
+            
+            for name, values, states in stateColumnList:
+                state = states[i]
+                if state == FIELD_VALUE:
+                    d[name] = values[i]
+                elif state == FIELD_NONE:
+                    d[name] = None
+            
+            # 字段全部来自打包的记录，因此跳过__init__中的默认值初始化
+            data = dataClass.__new__(dataClass)
+            data.__dict__ = d
+            yield data
+
+
+#----------------------------------------------------------------------
+def toPyList(values):
+    """将数组转换为Python原生类型的列表，时间转换为微秒精度后tolist才会得到datetime对象"""
+    if values.dtype.kind == 'M':
+        values = values.astype('datetime64[us]')
+    return values.tolist()
+
+
+# 并行回测时子进程中使用的全局数据，由initParallelWorker设置
+parallelStrategyClass = None
+parallelEngine = None
+parallelParamCache = False      # 是否复用子进程中已完成的回测结果
+parallelResultCache = {}        # 子进程中已完成回测的结果，key为策略实际生效的参数
+
+#----------------------------------------------------------------------
+def initParallelWorker(strategyClass, engineSetting, sharedData):
+    """
+    并行回测子进程的初始化函数，保存策略类，创建回测引擎，
+    并将共享内存中的历史数据设置到引擎中，子进程中的各组参数回测都复用该引擎
+    """
+    global parallelStrategyClass, parallelEngine, parallelParamCache
+    parallelStrategyClass = strategyClass
+    parallelParamCache = engineSetting.get('paramCache', False)
+    parallelResultCache.clear()
+    
+    s = engineSetting
+    engine = BacktestingEngine()
+    engine.setBacktestingMode(s['mode'])
+    engine.setStartDate(s['startDate'], s['initDays'])
+    engine.setEndDate(s['endDate'])
+    engine.setCapital(s['capital'])
+    engine.setSlippage(s['slippage'])
+    engine.setRate(s['rate'])
+    engine.setSize(s['size'])
+    engine.setPriceTick(s['priceTick'])
+    engine.setDatabase(s['dbName'], s['symbol'])
+    parallelEngine = engine
+    
+    if sharedData:
+        raw, dtype, count, fieldList, constDict, objectDict, initCount = sharedData
+        
+        # 所有字段都保存在常量字典中（或者没有数据）时，数组不占用内存
+        if dtype.itemsize and count:
+            array = np.frombuffer(raw, dtype=dtype, count=count)
+            array.flags.writeable = False       # 共享内存在所有子进程间共用，只读
+        else:
+            array = np.zeros(count, dtype)
+        history = (array, fieldList, constDict, objectDict)
+        
+        # 子进程中只保存共享内存上的数组，回测时才逐条生成数据对象
+        engine.setHistoryArray(history, initCount)
+
+
+#----------------------------------------------------------------------
+def runParallelWorker(setting):
+    """并行回测时在子进程中运行单组参数回测的函数"""
+    # 复用子进程中的回测引擎和历史数据，只清空上一组参数的回测结果
+    engine = parallelEngine
+    engine.clearBacktestingResult()
+    
+    engine.initStrategy(parallelStrategyClass, setting)
+    
+    # 启用了参数缓存时，策略实际生效参数和之前相同的设置不再重复回测
+    paramKey = None
+    if parallelParamCache:
+        paramKey = getParamKey(engine.strategy)
+    
+    if paramKey is not None and paramKey in parallelResultCache:
+        return (str(setting), parallelResultCache[paramKey])
+    
+    engine.runBacktesting()
+    
+    df = engine.calculateDailyResult()
+    df, d = engine.calculateDailyStatistics(df)
+    
+    if paramKey is not None:
+        parallelResultCache[paramKey] = d
+    return (str(setting), d)
+
 
 #----------------------------------------------------------------------
 def optimize(strategyClass, setting, targetName,
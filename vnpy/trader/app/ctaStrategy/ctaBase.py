@@ -42,6 +42,10 @@ EVENT_CTA_STRATEGY = 'eCtaStrategy.'    # CTA策略状态变化事件
 ########################################################################
 class StopOrder(object):
     """本地停止单"""
+    
+    # 回测时会创建大量停止单，使用__slots__减少内存占用和属性访问开销
+    __slots__ = ('vtSymbol', 'orderType', 'direction', 'offset', 'price', 'volume',
+                 'strategy', 'stopOrderID', 'status')
 
     #----------------------------------------------------------------------
     def __init__(self):
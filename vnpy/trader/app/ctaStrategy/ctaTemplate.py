@@ -4,8 +4,20 @@
 本文件包含了CTA引擎中的策略开发用模板，开发策略时需要继承CtaTemplate类。
 '''
 
+from functools import wraps
+
 import numpy as np
-import talib
+# 直接绑定常用指标函数，避免每次调用时查找，
+# 使用私有名称，策略中from ctaTemplate import *时不会导入这些名称
+from talib import (SMA as _talib_SMA, STDDEV as _talib_STDDEV, CCI as _talib_CCI, 
+                   ATR as _talib_ATR, RSI as _talib_RSI, MACD as _talib_MACD, ADX as _talib_ADX)
+
+# talib的stream接口只计算最新一个值，不生成完整的结果数组（较早版本的talib没有该接口）
+# 只用于非递推的指标，ATR、RSI等递推指标的stream结果和完整计算的最后一个值不同
+try:
+    from talib.stream import SMA as _streamSMA, STDDEV as _streamSTDDEV, CCI as _streamCCI
+except ImportError:
+    _streamSMA = _streamSTDDEV = _streamCCI = None
 
 from vnpy.trader.vtConstant import *
 from vnpy.trader.vtObject import VtBarData
@@ -13,6 +25,15 @@ from vnpy.trader.vtObject import VtBarData
 from .ctaBase import *
 
 
+# 目标持仓模板的委托类型，key为(是否买入, 是否平仓)
+TARGETPOS_ORDERTYPE = {
+    (True, False): CTAORDER_BUY,
+    (True, True): CTAORDER_COVER,
+    (False, False): CTAORDER_SHORT,
+    (False, True): CTAORDER_SELL
+}
+
+
 ########################################################################
 class CtaTemplate(object):
     """CTA策略模板"""
@@ -276,32 +297,29 @@ class TargetPosTemplate(CtaTemplate):
         if not posChange:
             return
         
-        # 确定委托基准价格，有tick数据时优先使用，否则使用bar
-        longPrice = 0
-        shortPrice = 0
+        # 确定委托方向、数量和基准价格，有tick数据时优先使用，否则使用bar
+        buy = posChange > 0
+        volume = abs(posChange)
+        tick = self.lastTick
         
-        if self.lastTick:
-            if posChange > 0:
-                longPrice = self.lastTick.askPrice1 + self.tickAdd
+        if tick:
+            if buy:
+                price = tick.askPrice1 + self.tickAdd
                 if tick.upperLimit:
-                    longPrice = min(longPrice, tick.upperLimit)         # 涨停价检查
+                    price = min(price, tick.upperLimit)         # 涨停价检查
             else:
-                shortPrice = self.lastTick.bidPrice1 - self.tickAdd
+                price = tick.bidPrice1 - self.tickAdd
                 if tick.lowerLimit:
-                    shortPrice = max(shortPrice, tick.lowerLimit)       # 跌停价检查
+                    price = max(price, tick.lowerLimit)         # 跌停价检查
         else:
-            if posChange > 0:
-                longPrice = self.lastBar.close + self.tickAdd
+            if buy:
+                price = self.lastBar.close + self.tickAdd
             else:
-                shortPrice = self.lastBar.close - self.tickAdd
+                price = self.lastBar.close - self.tickAdd
         
         # 回测模式下，采用合并平仓和反向开仓委托的方式
         if self.getEngineType() == ENGINETYPE_BACKTESTING:
-            if posChange > 0:
-                l = self.buy(longPrice, abs(posChange))
-            else:
-                l = self.short(shortPrice, abs(posChange))
-            self.orderList.extend(l)
+            orderType = TARGETPOS_ORDERTYPE[(buy, False)]
         
         # 实盘模式下，首先确保之前的委托都已经结束（全成、撤销）
         # 然后先发平仓委托，等待成交后，再发送新的开仓委托
@@ -310,29 +328,16 @@ class TargetPosTemplate(CtaTemplate):
             if self.orderList:
                 return
             
-            # 买入
-            if posChange > 0:
-                # 若当前有空头持仓
-                if self.pos < 0:
-                    # 若买入量小于空头持仓，则直接平空买入量
-                    if posChange < abs(self.pos):
-                        l = self.cover(longPrice, posChange)
-                    # 否则先平所有的空头仓位
-                    else:
-                        l = self.cover(longPrice, abs(self.pos))
-                # 若没有空头持仓，则执行开仓操作
-                else:
-                    l = self.buy(longPrice, abs(posChange))
-            # 卖出和以上相反
-            else:
-                if self.pos > 0:
-                    if abs(posChange) < self.pos:
-                        l = self.sell(shortPrice, abs(posChange))
-                    else:
-                        l = self.sell(shortPrice, abs(self.pos))
-                else:
-                    l = self.short(shortPrice, abs(posChange))
-            self.orderList.extend(l)
+            # 若有反向持仓，则先平仓，平仓数量不超过反向持仓；否则执行开仓操作
+            oppositePos = -self.pos if buy else self.pos
+            close = oppositePos > 0
+            if close:
+                volume = min(volume, oppositePos)
+            
+            orderType = TARGETPOS_ORDERTYPE[(buy, close)]
+        
+        l = self.sendOrder(orderType, price, volume)
+        self.orderList.extend(l)
     
     
 ########################################################################
@@ -355,50 +360,64 @@ class BarGenerator(object):
         
         self.lastTick = None        # 上一TICK缓存对象
         
+        self.barTemplate = None     # 新建K线对象用的模板，只包含合约信息
+        
+    #----------------------------------------------------------------------
+    def newBar(self, data):
+        """创建新的K线对象，合约信息来自data（Tick或K线）"""
+        template = self.barTemplate
+        
+        # 合约不变时直接复制模板，比重新初始化K线对象并设置合约信息更快
+        if not template or template.vtSymbol != data.vtSymbol:
+            template = VtBarData()
+            template.vtSymbol = data.vtSymbol
+            template.symbol = data.symbol
+            template.exchange = data.exchange
+            self.barTemplate = template
+        
+        return template.clone()
+        
     #----------------------------------------------------------------------
     def updateTick(self, tick):
         """TICK更新"""
-        newMinute = False   # 默认不是新的一分钟
-        
-        # 尚未创建对象
-        if not self.bar:
-            self.bar = VtBarData()
-            newMinute = True
-        # 新的一分钟
-        elif self.bar.datetime.minute != tick.datetime.minute:
-            # 生成上一分钟K线的时间戳
-            self.bar.datetime = self.bar.datetime.replace(second=0, microsecond=0)  # 将秒和微秒设为0
-            self.bar.date = self.bar.datetime.strftime('%Y%m%d')
-            self.bar.time = self.bar.datetime.strftime('%H:%M:%S.%f')
-            
-            # 推送已经结束的上一分钟K线
-            self.onBar(self.bar)
-            
-            # 创建新的K线对象
-            self.bar = VtBarData()
-            newMinute = True
+        bar = self.bar
+        lastPrice = tick.lastPrice
+        
+        # 尚未创建对象，或者新的一分钟
+        if not bar or bar.datetime.minute != tick.datetime.minute:
+            if bar:
+                # 生成上一分钟K线的时间戳
+                bar.datetime = bar.datetime.replace(second=0, microsecond=0)  # 将秒和微秒设为0
+                bar.date = bar.datetime.strftime('%Y%m%d')
+                bar.time = bar.datetime.strftime('%H:%M:%S.%f')
+                
+                # 推送已经结束的上一分钟K线
+                self.onBar(bar)
             
-        # 初始化新一分钟的K线数据
-        if newMinute:
-            self.bar.vtSymbol = tick.vtSymbol
-            self.bar.symbol = tick.symbol
-            self.bar.exchange = tick.exchange
-
-            self.bar.open = tick.lastPrice
-            self.bar.high = tick.lastPrice
-            self.bar.low = tick.lastPrice
-        # 累加更新老一分钟的K线数据
-        else:                                   
-            self.bar.high = max(self.bar.high, tick.lastPrice)
-            self.bar.low = min(self.bar.low, tick.lastPrice)
+            # 创建新的K线对象，初始化新一分钟的K线数据
+            bar = self.newBar(tick)
+            self.bar = bar
+
+            bar.open = lastPrice
+            bar.high = lastPrice
+            bar.low = lastPrice
+        # 累加更新老一分钟的K线数据，直接比较避免调用max/min
+        else:
+            if lastPrice > bar.high:
+                bar.high = lastPrice
+            elif lastPrice < bar.low:
+                bar.low = lastPrice
 
         # 通用更新部分
-        self.bar.close = tick.lastPrice        
-        self.bar.datetime = tick.datetime  
-        self.bar.openInterest = tick.openInterest
+        bar.close = lastPrice
+        bar.datetime = tick.datetime  
+        bar.openInterest = tick.openInterest
    
+        # 当前K线内的成交量，新交易日开始时tick成交量重新累计，此时增量为负，不计入
         if self.lastTick:
-            self.bar.volume += (tick.volume - self.lastTick.volume) # 当前K线内的成交量
+            volumeChange = tick.volume - self.lastTick.volume
+            if volumeChange > 0:
+                bar.volume += volumeChange
             
         # 缓存Tick
         self.lastTick = tick
@@ -406,43 +425,112 @@ class BarGenerator(object):
     #----------------------------------------------------------------------
     def updateBar(self, bar):
         """1分钟K线更新"""
+        xminBar = self.xminBar
+        
         # 尚未创建对象
-        if not self.xminBar:
-            self.xminBar = VtBarData()
-            
-            self.xminBar.vtSymbol = bar.vtSymbol
-            self.xminBar.symbol = bar.symbol
-            self.xminBar.exchange = bar.exchange
+        if not xminBar:
+            xminBar = self.newBar(bar)
+            self.xminBar = xminBar
         
-            self.xminBar.open = bar.open
-            self.xminBar.high = bar.high
-            self.xminBar.low = bar.low            
+            xminBar.open = bar.open
+            xminBar.high = bar.high
+            xminBar.low = bar.low            
             
-            self.xminBar.datetime = bar.datetime    # 以第一根分钟K线的开始时间戳作为X分钟线的时间戳
-        # 累加老K线
+            xminBar.datetime = bar.datetime    # 以第一根分钟K线的开始时间戳作为X分钟线的时间戳
+        # 累加老K线，直接比较避免调用max/min
         else:
-            self.xminBar.high = max(self.xminBar.high, bar.high)
-            self.xminBar.low = min(self.xminBar.low, bar.low)
+            if bar.high > xminBar.high:
+                xminBar.high = bar.high
+            if bar.low < xminBar.low:
+                xminBar.low = bar.low
     
         # 通用部分
-        self.xminBar.close = bar.close        
-        self.xminBar.openInterest = bar.openInterest
-        self.xminBar.volume += int(bar.volume)                
+        xminBar.close = bar.close        
+        xminBar.openInterest = bar.openInterest
+        xminBar.volume += int(bar.volume)                
             
         # X分钟已经走完
         if not (bar.datetime.minute + 1) % self.xmin:   # 可以用X整除
             # 生成上一X分钟K线的时间戳
-            self.xminBar.datetime = self.xminBar.datetime.replace(second=0, microsecond=0)  # 将秒和微秒设为0
-            self.xminBar.date = self.xminBar.datetime.strftime('%Y%m%d')
-            self.xminBar.time = self.xminBar.datetime.strftime('%H:%M:%S.%f')
+            xminBar.datetime = xminBar.datetime.replace(second=0, microsecond=0)  # 将秒和微秒设为0
+            xminBar.date = xminBar.datetime.strftime('%Y%m%d')
+            xminBar.time = xminBar.datetime.strftime('%H:%M:%S.%f')
             
             # 推送
-            self.onXminBar(self.xminBar)
+            self.onXminBar(xminBar)
             
             # 清空老K线缓存对象
             self.xminBar = None
 
 
+#----------------------------------------------------------------------
+def cacheIndicator(func):
+    """
+    ArrayManager指标计算函数的装饰器，同一根K线上以相同参数重复调用时直接返回之前的结果
+    注意返回的数组为缓存对象，不应在外部修改
+    """
+    name = func.__name__
+    
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        key = (name, args, tuple(sorted(kwargs.items())))
+        cache = self.indicatorCache
+        
+        if key in cache:
+            return cache[key]
+        
+        result = func(self, *args, **kwargs)
+        cache[key] = result
+        return result
+    
+    return wrapper
+
+
+# talib的abstract接口函数对象缓存，key为函数名
+abstractFunctionDict = {}
+
+#----------------------------------------------------------------------
+def getAbstractFunction(name):
+    """获取talib的abstract接口函数对象，创建后缓存复用"""
+    function = abstractFunctionDict.get(name)
+    
+    if function is None:
+        from talib import abstract      # 只在使用时载入
+        function = abstract.Function(name)
+        abstractFunctionDict[name] = function
+    
+    return function
+
+
+# talib指标的lookback缓存，key为(函数名, 参数)
+lookbackDict = {}
+
+#----------------------------------------------------------------------
+def getLookback(name, **params):
+    """
+    获取talib指标在给定参数下的lookback，即第一个有效结果之前的数据数量，
+    数据数量需要大于lookback才能得到有效结果，计算后缓存复用
+    """
+    key = (name, tuple(sorted(params.items())))
+    lookback = lookbackDict.get(key)
+    
+    if lookback is None:
+        # 单独创建函数对象，避免修改getAbstractFunction缓存的函数对象的参数
+        from talib import abstract
+        lookback = abstract.Function(name, **params).lookback
+        lookbackDict[key] = lookback
+    
+    return lookback
+
+
+#----------------------------------------------------------------------
+def slidingWindow(array, n):
+    """返回一维数组上长度为n的滑动窗口视图（不复制数据），形状为(len(array)-n+1, n)"""
+    stride = array.strides[0]
+    return np.lib.stride_tricks.as_strided(array, shape=(len(array)-n+1, n), 
+                                           strides=(stride, stride), writeable=False)
+
+
 ########################################################################
 class ArrayManager(object):
     """
@@ -458,11 +546,15 @@ class ArrayManager(object):
         self.size = size                    # 缓存大小
         self.inited = False                 # True if count>=size
         
-        self.openArray = np.zeros(size)     # OHLC
-        self.highArray = np.zeros(size)
-        self.lowArray = np.zeros(size)
-        self.closeArray = np.zeros(size)
-        self.volumeArray = np.zeros(size)
+        # OHLCV环形缓存，每行对应一个序列，每个序列保存两份：
+        # 新数据同时写入head和head+size两个位置，写入后head后移一位，
+        # 因此buffer[:, head:head+size]始终是按时间顺序排列的连续数组，
+        # 更新时无需整体平移数据
+        self.buffer = np.zeros((5, size * 2))
+        self.head = 0                       # 下一根K线写入的位置，也是最早一根K线的位置
+        self.updateArray()
+        
+        self.indicatorCache = {}            # 当前K线上已计算的指标结果，更新K线时清空
         
     #----------------------------------------------------------------------
     def updateBar(self, bar):
@@ -471,136 +563,243 @@ class ArrayManager(object):
         if not self.inited and self.count >= self.size:
             self.inited = True
         
-        self.openArray[0:self.size-1] = self.openArray[1:self.size]
-        self.highArray[0:self.size-1] = self.highArray[1:self.size]
-        self.lowArray[0:self.size-1] = self.lowArray[1:self.size]
-        self.closeArray[0:self.size-1] = self.closeArray[1:self.size]
-        self.volumeArray[0:self.size-1] = self.volumeArray[1:self.size]
-    
-        self.openArray[-1] = bar.open
-        self.highArray[-1] = bar.high
-        self.lowArray[-1] = bar.low        
-        self.closeArray[-1] = bar.close
-        self.volumeArray[-1] = bar.volume
+        values = (bar.open, bar.high, bar.low, bar.close, bar.volume)
+        buffer = self.buffer
+        buffer[:, self.head] = values
+        buffer[:, self.head + self.size] = values
         
-    #----------------------------------------------------------------------
-    @property
-    def open(self):
-        """获取开盘价序列"""
-        return self.openArray
+        self.head += 1
+        if self.head == self.size:
+            self.head = 0
         
-    #----------------------------------------------------------------------
-    @property
-    def high(self):
-        """获取最高价序列"""
-        return self.highArray
+        self.updateArray()
+        self.indicatorCache.clear()
     
     #----------------------------------------------------------------------
-    @property
-    def low(self):
-        """获取最低价序列"""
-        return self.lowArray
+    def updateArray(self):
+        """
+        更新各序列对应的缓存视图（不复制数据）
+        open/high/low/close/volume为普通属性，指标计算时直接读取，无需经过property
+        """
+        start = self.head
+        end = start + self.size
+        buffer = self.buffer
+        
+        self.open = self.openArray = buffer[0, start:end]         # OHLC
+        self.high = self.highArray = buffer[1, start:end]
+        self.low = self.lowArray = buffer[2, start:end]
+        self.close = self.closeArray = buffer[3, start:end]
+        self.volume = self.volumeArray = buffer[4, start:end]
+        
+    #----------------------------------------------------------------------
+    def nanResult(self, array=False):
+        """数据不足以计算指标时返回的结果"""
+        if array:
+            return np.full(self.size, np.nan)
+        return np.nan
     
     #----------------------------------------------------------------------
-    @property
-    def close(self):
-        """获取收盘价序列"""
-        return self.closeArray
+    def validData(self, data):
+        """
+        缓存未填满时只返回已更新的数据，ATR等递推指标会从序列开头累积，
+        不能让缓存中初始的0参与计算
+        """
+        if self.inited:
+            return data
+        return data[-self.count:]
     
     #----------------------------------------------------------------------
-    @property    
-    def volume(self):
-        """获取成交量序列"""
-        return self.volumeArray
+    def fullResult(self, result):
+        """将validData数据计算出的结果数组在前面补NaN，恢复为缓存大小"""
+        if len(result) == self.size:
+            return result
+        
+        full = np.full(self.size, np.nan)
+        full[-len(result):] = result
+        return full
     
     #----------------------------------------------------------------------
+    @cacheIndicator
     def sma(self, n, array=False):
         """简单均线"""
-        result = talib.SMA(self.close, n)
+        if self.count < n:                  # 数据不足时不调用talib
+            return self.nanResult(array)
+        
+        if not array and _streamSMA:
+            return _streamSMA(self.close, n)
+        
+        result = _talib_SMA(self.close, n)
         if array:
             return result
         return result[-1]
         
     #----------------------------------------------------------------------
+    @cacheIndicator
     def std(self, n, array=False):
         """标准差"""
-        result = talib.STDDEV(self.close, n)
+        if self.count < n:                  # 数据不足时不调用talib
+            return self.nanResult(array)
+        
+        if not array and _streamSTDDEV:
+            return _streamSTDDEV(self.close, n)
+        
+        result = _talib_STDDEV(self.close, n)
         if array:
             return result
         return result[-1]
     
     #----------------------------------------------------------------------
+    @cacheIndicator
     def cci(self, n, array=False):
         """CCI指标"""
-        result = talib.CCI(self.high, self.low, self.close, n)
+        if self.count < n:                  # 数据不足时不调用talib
+            return self.nanResult(array)
+        
+        if not array and _streamCCI:
+            return _streamCCI(self.high, self.low, self.close, n)
+        
+        result = _talib_CCI(self.high, self.low, self.close, n)
         if array:
             return result
         return result[-1]
         
     #----------------------------------------------------------------------
+    @cacheIndicator
     def atr(self, n, array=False):
         """ATR指标"""
-        result = talib.ATR(self.high, self.low, self.close, n)
+        if self.count <= getLookback('ATR', timeperiod=n):     # 数据不足时不调用talib
+            return self.nanResult(array)
+        
+        result = _talib_ATR(self.validData(self.high), self.validData(self.low), 
+                            self.validData(self.close), n)
         if array:
-            return result
+            return self.fullResult(result)
         return result[-1]
         
     #----------------------------------------------------------------------
+    @cacheIndicator
     def rsi(self, n, array=False):
         """RSI指标"""
-        result = talib.RSI(self.close, n)
+        if self.count <= getLookback('RSI', timeperiod=n):     # 数据不足时不调用talib
+            return self.nanResult(array)
+        
+        result = _talib_RSI(self.validData(self.close), n)
         if array:
-            return result
+            return self.fullResult(result)
         return result[-1]
     
     #----------------------------------------------------------------------
+    @cacheIndicator
     def macd(self, fastPeriod, slowPeriod, signalPeriod, array=False):
         """MACD指标"""
-        macd, signal, hist = talib.MACD(self.close, fastPeriod,
-                                        slowPeriod, signalPeriod)
+        lookback = getLookback('MACD', fastperiod=fastPeriod, slowperiod=slowPeriod, 
+                               signalperiod=signalPeriod)
+        if self.count <= lookback:          # 数据不足时不调用talib
+            return self.nanResult(array), self.nanResult(array), self.nanResult(array)
+        
+        macd, signal, hist = _talib_MACD(self.validData(self.close), fastPeriod,
+                                         slowPeriod, signalPeriod)
         if array:
-            return macd, signal, hist
+            return self.fullResult(macd), self.fullResult(signal), self.fullResult(hist)
         return macd[-1], signal[-1], hist[-1]
     
     #----------------------------------------------------------------------
+    @cacheIndicator
     def adx(self, n, array=False):
         """ADX指标"""
-        result = talib.ADX(self.high, self.low, self.close, n)
+        if self.count <= getLookback('ADX', timeperiod=n):     # 数据不足时不调用talib
+            return self.nanResult(array)
+        
+        result = _talib_ADX(self.validData(self.high), self.validData(self.low), 
+                            self.validData(self.close), n)
         if array:
-            return result
+            return self.fullResult(result)
         return result[-1]
     
     #----------------------------------------------------------------------
+    @cacheIndicator
     def boll(self, n, dev, array=False):
         """布林通道"""
         mid = self.sma(n, array)
         std = self.std(n, array)
         
-        up = mid + std * dev
-        down = mid - std * dev
+        width = std * dev
+        up = mid + width
+        down = mid - width
         
         return up, down    
     
     #----------------------------------------------------------------------
+    @cacheIndicator
     def keltner(self, n, dev, array=False):
         """肯特纳通道"""
         mid = self.sma(n, array)
         atr = self.atr(n, array)
         
-        up = mid + atr * dev
-        down = mid - atr * dev
+        width = atr * dev
+        up = mid + width
+        down = mid - width
         
         return up, down
     
     #----------------------------------------------------------------------
+    @cacheIndicator
     def donchian(self, n, array=False):
         """唐奇安通道"""
-        up = talib.MAX(self.high, n)
-        down = talib.MIN(self.low, n)
+        # 直接用numpy计算窗口最大最小值，避免talib的MAX/MIN在单调序列上极慢的情况
+        if n > self.count or n > self.size:
+            return self.nanResult(array), self.nanResult(array)
+        
+        # 只需要最新值时，只扫描最后n个数据
+        if not array:
+            return self.high[-n:].max(), self.low[-n:].min()
+        
+        up = np.full(self.size, np.nan)
+        down = np.full(self.size, np.nan)
+        up[n-1:] = slidingWindow(self.high, n).max(axis=1)
+        down[n-1:] = slidingWindow(self.low, n).min(axis=1)
+        return up, down
+    
+    #----------------------------------------------------------------------
+    def compute(self, specs, array=False):
+        """
+        批量计算多个指标
+        specs：指标列表，每项为(方法名, 参数...)的元组，如[('sma', 20), ('rsi', 14), ('boll', 20, 2)]
+        返回以指标元组为键的字典，重复的指标只计算一次
+        """
+        result = {}
+        
+        for spec in specs:
+            if spec not in result:
+                result[spec] = getattr(self, spec[0])(*spec[1:], array=array)
+        
+        return result
+    
+    #----------------------------------------------------------------------
+    def bulk(self, specs):
+        """
+        通过talib的abstract接口批量计算任意talib指标
+        specs：指标列表，每项为(talib函数名, 参数字典)，如[('SMA', {'timeperiod': 20}), ('RSI', {})]
+        返回和specs顺序一致的结果列表，每项为完整的结果数组（多输出的指标为数组列表）
+        """
+        inputs = {
+            'open': self.open,
+            'high': self.high,
+            'low': self.low,
+            'close': self.close,
+            'volume': self.volume
+        }
+        cache = self.indicatorCache
+        
+        resultList = []
+        for name, params in specs:
+            key = ('bulk', name, tuple(sorted(params.items())))
+            
+            if key not in cache:
+                cache[key] = getAbstractFunction(name)(inputs, **params)
+            resultList.append(cache[key])
         
-        if array:
-            return up, down
-        return up[-1], down[-1]
+        return resultList
     
 
 ########################################################################
@@ -100,6 +100,13 @@ class VtBarData(VtBaseData):
         
         self.volume = EMPTY_INT             # 成交量
         self.openInterest = EMPTY_INT       # 持仓量    
+        
+    #----------------------------------------------------------------------
+    def clone(self):
+        """复制K线对象（浅拷贝），比重新创建更快"""
+        bar = VtBarData.__new__(VtBarData)
+        bar.__dict__ = self.__dict__.copy()
+        return bar
     
 
 ########################################################################